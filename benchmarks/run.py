@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+""" Measure the throughput, startup time and peak memory of the `pz` processing modes on synthetic corpora,
+    next to the `awk`, `sed`, `grep`... baseline doing about the same work.
+
+    Store the results as JSON to compare the runs across versions:
+        benchmarks/run.py -o before.json
+        git checkout feature && benchmarks/run.py --compare before.json
+    The comparison fails if a mode got slower (or took more memory) than the threshold allows.
+"""
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+from argparse import ArgumentParser
+from datetime import datetime
+from pathlib import Path
+from shutil import which
+from statistics import median
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+ROOT = Path(__file__).resolve().parent.parent
+WORDS = ("lorem", "ipsum", "dolor", "sit", "amet", "GET", "POST", "200", "404", "-", "Mozilla/5.0", "[16/Oct/2026]")
+URLS = ("http://example.com/index.html", "https://nic.cz/page?id=42", "https://csirt.cz/", "http://a.b/c/d/e.png")
+
+# name, corpus, `pz` arguments, baseline command; NUM stands for the number of lines
+CASES = (
+    ("startup", "tiny", ["s"], ["awk", "{print}"]),
+    ("plain", "csv", ["s.upper()"], ["awk", "{print toupper($0)}"]),
+    ("columns", "csv", ["s.split(',')[2]"], ["cut", "-d,", "-f3"]),
+    ("filter", "numbers", ["--filter", "n > 500"], ["awk", "$1 > 500"]),
+    ("format", "csv", ["--format", "{s}!"], ["sed", "s/$/!/"]),
+    ("findall", "log", ["--findall", r"https?://\S+"], ["grep", "-oE", "https?://[^[:space:]]+"]),
+    ("search", "log", ["--search", r"GET \S+"], ["grep", "-oE", "GET [^[:space:]]+"]),
+    ("sub", "log", ["https", "--sub", "http"], ["sed", "s/https/http/g"]),
+    ("whole", "log", ["--whole", "--end", "len(text)"], ["wc", "-c"]),
+    ("lines", "log", ["--end", "len(lines)"], ["wc", "-l"]),
+    ("numbers", "numbers", ["--end", "sum(numbers)"], ["awk", "{s += $1} END {print s}"]),
+    ("generate", None, ["-g", "NUM", "s"], ["seq", "NUM"]),
+    ("stderr", "csv", ["--stderr", "s.lower()"], ["tee", "/dev/stderr"]),
+    ("long-lines", "long", ["s[:10]"], ["cut", "-c1-10"]),
+    ("invalid-utf8", "invalid", ["s"], ["cat"]),
+)
+
+
+def make_corpora(directory: Path, count: int):
+    """ Write the synthetic corpora of about `count` lines, the same for every run. Return {name: (path, lines)}.
+        The lines are generated one by one so that the peak memory of this process stays low (see `measure`). """
+    rand = random.Random(0)
+    corpora = {
+        "tiny": (b"hello" for _ in range(1)),
+        "numbers": (str(rand.choice((rand.randint(0, 1000), round(rand.uniform(0, 1000), 3)))).encode()
+                    for _ in range(count)),
+        "csv": (f"{i},{rand.choice(WORDS)},{rand.randint(0, 10 ** 6)},{rand.choice(WORDS)} {rand.choice(WORDS)}"
+                .encode() for i in range(count)),
+        "log": (" ".join(rand.choice(WORDS + URLS) for _ in range(10)).encode() for _ in range(count)),
+        "long": (" ".join(rand.choice(WORDS) for _ in range(2000)).encode() for _ in range(max(count // 200, 1))),
+        "invalid": ((rand.choice(WORDS) + " ").encode() + (b"\xff\xfe" if not i % 10 else b"ok") for i in range(count)),
+    }
+    result = {}
+    for name, lines in corpora.items():
+        path = directory / f"{name}.txt"
+        written = 0
+        with path.open("wb") as f:
+            for line in lines:
+                f.write(line + b"\n")
+                written += 1
+        result[name] = path, written
+    return result
+
+
+def measure(command, stdin_path, repeat):
+    """ Run the command `repeat` times. Return the median wall time in seconds and the peak RSS in KiB.
+        Note the kernel counts the memory of this process the command was forked from into the peak RSS,
+        hence the `rss_floor_kib` of the results tells the least value to be measured. """
+    times, rss = [], 0
+    for _ in range(repeat):
+        with open(stdin_path or os.devnull, "rb") as stdin:
+            start = perf_counter()
+            process = subprocess.Popen(command, stdin=stdin, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            _, status, usage = os.wait4(process.pid, 0)
+            times.append(perf_counter() - start)
+        process.returncode = status  # already reaped by `wait4`
+        if status:
+            raise RuntimeError(f"Command failed with the status {status}: {command}")
+        rss = max(rss, usage.ru_maxrss // (1024 if sys.platform == "darwin" else 1))  # macOS reports bytes
+    return median(times), rss
+
+
+def run(pz, count, repeat, only, corpora_dir):
+    """ Run the cases and return the results. """
+    corpora = make_corpora(corpora_dir, count)
+    results = {}
+    for name, corpus, arguments, baseline in CASES:
+        if only and not re.search(only, name):
+            continue
+        path, lines = corpora[corpus] if corpus else (None, count)
+        size = path.stat().st_size if path else None
+        arguments = [str(count) if x == "NUM" else x for x in arguments]
+        baseline = [str(count) if x == "NUM" else x for x in baseline]
+        seconds, rss = measure([sys.executable, str(pz), *arguments], path, repeat)
+        result = {"command": ["pz", *arguments], "seconds": seconds, "max_rss_kib": rss,
+                  "lines_per_second": lines / seconds, "mb_per_second": size / seconds / 2 ** 20 if size else None}
+        if which(baseline[0]):
+            seconds, rss = measure(baseline, path, repeat)
+            result["baseline"] = {"command": baseline, "seconds": seconds, "max_rss_kib": rss}
+        results[name] = result
+        print_result(name, result)
+    return results
+
+
+def print_result(name, result):
+    """ Print a row of the results table. """
+    baseline = result.get("baseline")
+    print(f"{name:<14} {result['seconds'] * 1000:9.1f} ms {result['lines_per_second']:13,.0f} lines/s"
+          f" {result['max_rss_kib'] / 1024:7.1f} MiB"
+          + (f"   {baseline['command'][0]:<5} {baseline['seconds'] * 1000:9.1f} ms"
+             f" {baseline['max_rss_kib'] / 1024:7.1f} MiB  ×{result['seconds'] / baseline['seconds']:.1f}"
+             if baseline else ""), flush=True)
+
+
+def compare(results, previous, threshold):
+    """ Print the modes that got slower or take more memory than the threshold allows. Return their count. """
+    regressions = 0
+    for name, result in results.items():
+        if name not in previous:
+            continue
+        for key, label in (("seconds", "time"), ("max_rss_kib", "max RSS")):
+            before, now = previous[name][key], result[key]
+            if now > before * (1 + threshold):
+                regressions += 1
+                print(f"REGRESSION {name}: {label} {before:.4g} → {now:.4g} (+{(now / before - 1) * 100:.0f} %)")
+    return regressions
+
+
+def version(pz):
+    """ Describe the benchmarked version by git, if possible. """
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=Path(pz).parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--pz", help="The `pz` script to benchmark.", default=ROOT / "pz", type=Path)
+    parser.add_argument("-n", "--lines", help="Number of lines of the corpora.", default=200_000, type=int)
+    parser.add_argument("-r", "--repeat", help="Number of runs of every command, the median is taken.",
+                        default=3, type=int)
+    parser.add_argument("--only", help="Run just the cases whose name matches the regular expression.")
+    parser.add_argument("--corpora", help="Keep the generated corpora in the directory.", type=Path)
+    parser.add_argument("-o", "--output", help="Save the results to the JSON file.", type=Path)
+    parser.add_argument("--compare", help="Compare to the results from the JSON file.", type=Path)
+    parser.add_argument("--threshold", help="Allowed slowdown ratio when comparing, 0.1 = 10 %%.",
+                        default=0.1, type=float)
+    args = parser.parse_args()
+
+    rss_floor = measure(["true"], None, 1)[1]
+    print(f"Peak RSS measured cannot go below {rss_floor / 1024:.1f} MiB.")
+    with TemporaryDirectory() as tmp:
+        corpora_dir = args.corpora or Path(tmp)
+        corpora_dir.mkdir(parents=True, exist_ok=True)
+        results = run(args.pz, args.lines, args.repeat, args.only, corpora_dir)
+
+    if args.output:
+        args.output.write_text(json.dumps({
+            "version": version(args.pz),
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "lines": args.lines,
+            "rss_floor_kib": rss_floor,
+            "results": results}, indent=2))
+    if args.compare:
+        previous = json.loads(args.compare.read_text())
+        if previous.get("lines") != args.lines:
+            print(f"Warning: the corpora differ, {previous.get('lines')} lines compared to {args.lines}")
+        if compare(results, previous["results"], args.threshold):
+            sys.exit(1)
+        print(f"No regression against {args.compare} ({previous.get('version')})")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,7 @@ _pz()
   cmd=( ${COMP_WORDS[@]} )
 
   if [[ "$cur" == -* ]]; then
-    COMPREPLY=( $( compgen -W "-h --help -v --verbose -q --quiet -S --setup -E --end -F --filter -f --format -w --whole -n -1 -0 --empty -g --generate --stderr --overflow-safe --search --match --findall --sub" -- $cur ) )
+    COMPREPLY=( $( compgen -W "-h --help -v --verbose -q --quiet -c --chain -S --setup -E --end -F --filter -f --format -w --whole --csv --jsonl --input -n -1 -0 --empty -g --generate --stderr --overflow-safe --search --match --findall --sub -j --jobs --unordered --concurrency --batch --split --serve --stats --profile --memo --memo-size --memo-file --flush --sort --group-by --agg --mem-limit" -- $cur ) )
     return 0
   fi
 }
@@ -0,0 +1,2906 @@
+# The code of the `pz` utility. The `pz` launcher runs it as the `__main__` module, as `python3 -m pz_core` would.
+import builtins
+import io
+import math
+import os
+import re
+import stat
+import sys
+from collections import Counter, OrderedDict, deque
+from array import array
+from collections.abc import Iterable, Callable
+from _thread import allocate_lock, get_ident
+from contextlib import contextmanager
+from itertools import islice, count as count_from, repeat, zip_longest
+
+
+# logging (importing the `logging` module would take longer than the whole `pz s` run)
+class Logger:
+    """ Print the messages of the given level and above to the STDERR. """
+    DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+
+    def __init__(self):
+        self.level = self.INFO
+        self.stream = sys.stderr
+
+    def log(self, level, message):
+        if level >= self.level:
+            print(message, file=self.stream, flush=True)
+
+    def debug(self, message):
+        self.log(self.DEBUG, message)
+
+    def info(self, message):
+        self.log(self.INFO, message)
+
+    def warning(self, message):
+        self.log(self.WARNING, message)
+
+    def error(self, message):
+        self.log(self.ERROR, message)
+
+
+logger = Logger()
+
+# names that can be imported
+available_names = {"Path": "pathlib",
+                   "datetime": "datetime",
+                   "sleep": "time",
+                   "time": "time",
+                   "randint": "random",
+                   "get": "requests",
+                   "b64encode": "base64",
+                   "b64decode": "base64",
+                   "glob": "glob",
+                   "iglob": "glob",
+                   "ZipFile": "zipfile",
+                   "defaultdict": "collections"}
+star_modules = ("math", "re")  # as if `from math import *` and `from re import *`, however imported when referenced
+_module_clash = {v for k, v in available_names.items() if k == v}  # ex: do not import glob in favour of glob.glob
+available_modules = ({x for x in available_names.values() if x not in _module_clash}
+                     .union(("csv", "jsonpickle", "humanize", "webbrowser", "collections", "itertools", "numpy")))
+
+__doc__ = (f"Launch your tiny Python script on a piped in contents and pipe it out"
+           "\n"
+           "\nAvailable without import:"
+           "\n Loaded: re.* (match, search, findall), math.* (sqrt,...)"
+           f"\n Auto-imported functions: {', '.join(sorted(available_names.keys(), key=str.casefold))}"
+           f"\n Auto-imported modules: {', '.join(sorted(available_modules))}"
+           f"\n"
+           f"\nAvailable variables:"
+           f"\n * s – current line"
+           f"\n * n – current line converted to an `int` (or `float`) if possible"
+           f"\n * b – current line as a byte-string"
+           f"\n * count – current line number"           
+           f"\n * filename, file_count – current FILE and line number within it"
+           f"\n * text – whole text, all lines together"
+           f"\n * lines – list of lines so far processed"
+           f"\n * numbers – list of numbers so far processed"
+           f"\n * skip – omit line if True"
+           f"\n * i=0, S=set(), L=list(), D=dict(), C=Counter() – other global variables"
+           f"\n * R, P – running stats (R.mean, R.stdev...) and percentiles (P.quantile(0.99)) of the numbers"
+           f"\n * H, K – distinct lines count (HyperLogLog) and the top-k most common lines (K.most_common(10))"
+           )
+
+
+# parse arguments
+class Arguments:
+    """ Arguments of the common `pz COMMAND` invocation: just the main clause, no flag set. """
+
+    def __init__(self, main):
+        self.main = main
+
+    def __getattr__(self, name):
+        return None
+
+
+def generate_range(value):
+    """ Parse the `--generate` argument: `NUM` (1 .. NUM, `0` means infinity) or `START:STOP[:STEP]`
+        (STOP included, an empty STOP means infinity). The numbers may use an exponent, ex: `1:1e9:10`.
+        Return (start, stop or None, step). """
+    def integer(x):
+        try:
+            return int(x)
+        except ValueError:
+            f = float(x)
+            if not f.is_integer():
+                raise
+            return int(f)
+
+    parts = value.split(":")
+    if len(parts) == 1:
+        stop = integer(value)
+        if stop < 0:
+            raise ValueError(value)
+        return 1, stop or None, 1
+    if len(parts) > 3:
+        raise ValueError(value)
+    start, stop, step = parts + [""] * (3 - len(parts))
+    step = integer(step) if step else 1
+    if not step:
+        raise ValueError(value)
+    return integer(start) if start else 1, integer(stop) if stop else None, step
+
+
+def flush_policy(value):
+    """ Parse the `--flush` policy: `line`, `never` or the comma-separated bounds like `50ms`, `0.5s`, `64KiB`, `1M`.
+        Return (flush every line, buffer size or None for the default, flush interval in seconds,
+        flush when the input goes idle). """
+    if value == "line":
+        return True, None, None, False
+    if value == "never":
+        return False, None, None, False
+    size = interval = None
+    for bound in filter(None, value.split(",")):
+        m = re.fullmatch(r"(\d+(?:\.\d+)?)\s*(ms|s)", bound.strip())
+        if m:
+            interval = float(m[1]) / (1000 if m[2] == "ms" else 1)
+        else:
+            size = parse_size(bound)
+    return False, size, interval, True
+
+
+def positive_int(value):
+    """ Parse the number of the workers, threads or lines like `--jobs`, `--concurrency`, `--batch`. """
+    number = int(value)
+    if number < 1:
+        raise ValueError(value)
+    return number
+
+
+def parse_size(value):
+    """ Parse the size like `512`, `64KiB`, `1M` or `2G` to bytes. """
+    m = re.fullmatch(r"(\d+(?:\.\d+)?)\s*(B|K|KiB|M|MiB|G|GiB)?", value.strip())
+    if not m:
+        raise ValueError(value)
+    unit = {"B": 1, "K": 1 << 10, "KiB": 1 << 10, "M": 1 << 20, "MiB": 1 << 20, "G": 1 << 30, "GiB": 1 << 30}
+    return max(1, int(float(m[1]) * unit[m[2] or "B"]))
+
+
+def parse_args():
+    """ Parse the command line. A single positional argument does not need the argparse (it takes long to import). """
+    if len(sys.argv) == 2 and not sys.argv[1].startswith("-"):
+        return Arguments(sys.argv[1])
+
+    import argparse
+    parser = argparse.ArgumentParser(prog="pz", description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-v", "--verbose", help='Show automatic imports and internal command modification',
+                        action="store_true")
+    parser.add_argument("-q", "--quiet", help='Suppress command exceptions', action='store_true')
+
+    group1 = parser.add_argument_group("Command clauses")
+    group1.add_argument("main", help='Any Python script executed on every line (multiple statements allowed)',
+                        metavar="COMMAND", nargs="?")
+    group1.add_argument("-c", "--chain", help='Another main clause, run on every line the previous clause outputs.'
+                                              ' The value passes as an object: `s` holds its text, `n` the number,'
+                                              ' `r` the tuple. Every clause counts its own `count`, `lines`, `numbers`,'
+                                              ' the end clause sees those of the last one. Might be repeated.',
+                        action="append", metavar="COMMAND")
+    group1.add_argument("-E", "--end", help='Any Python script, executed after processing.'
+                                            ' Useful for final output.', metavar="COMMAND")
+    group1.add_argument("-S", "--setup", help='Any Python script, executed before processing.'
+                                              ' Useful for variable initializing.', metavar="COMMAND")
+    group1.add_argument("-I", "--insecure", help='If set, any Python script in the environment variable `PZ_SETUP`'
+                                                 ' will be executed just before the `--setup` clause. Useful for imports.',
+                        action="store_true")
+    group1.add_argument("-F", "--filter", help='Line is piped out unchanged, however only if evaluated to True.',
+                        action='store_true')
+    group1.add_argument("-f", "--format", help='Main and end clauses are considered f-strings.', action='store_true')
+
+    group2 = parser.add_argument_group("Populating variables")
+    group2.add_argument("-w", "--whole", help='Wait till whole text fetched and then process.'
+                                              ' Variable `text` is available containing whole text.', action='store_true')
+    group2.add_argument("--split", help='Delimiter of the columns. Variable `r` holds the tuple of the fields of the line,'
+                                        ' an output tuple is joined by the DELIM. (With --batch, see `COLS`.)',
+                        metavar="DELIM")
+    group2.add_argument("--csv", help='Variable `r` holds the tuple of the CSV fields of the line (delimited by'
+                                      ' the --split DELIM, by default a comma), an output tuple is written as a CSV row.',
+                        action='store_true')
+    group2.add_argument("--jsonl", help='Variable `r` holds the line parsed as JSON, an output dict or tuple'
+                                        ' is written as JSON.', action='store_true')
+
+    group3 = parser.add_argument_group("Input / output")
+    group3.add_argument("files", help='Files to process instead of the STDIN (`-`), one after another. A glob pattern'
+                                      ' is expanded, ex: `"logs/*.gz"`. A gzip, bz2, xz or zstd file is decompressed.'
+                                      ' Variable `filename` holds the name of the file, `file_count`'
+                                      ' the line number within the file.', nargs="*", metavar="FILE")
+    group3.add_argument("--input", help='The same as FILE, useful when there is no main COMMAND. Might be repeated.',
+                        action="append", metavar="FILE")
+    group3.add_argument("-n", help='Process only such number of lines.', type=int, metavar="NUM")
+    group3.add_argument("-1", help='Process just first line.', action='store_const', dest="n", const=1)
+    group3.add_argument("-0", help='Skip all lines output. (Useful in combination with --end.)', action='store_true',
+                        dest="zero")
+    group3.add_argument("--empty", help='Output empty lines. (By default skipped.)', action='store_true')
+    group3.add_argument("-g", "--generate", help='Generate lines while ignoring the input pipe.'
+                                                 ' Line will correspond to the iteration cycle count.'
+                                                 ' By default `NUM=5`; `NUM=0` means infinity.'
+                                                 ' Or the range `START:STOP[:STEP]` with STOP included'
+                                                 ' (empty means infinity), ex: `1:1e9:10`.',
+                        nargs="?", type=generate_range, metavar="NUM", const=(1, 5, 1))
+    group3.add_argument("--stderr", help='Print commands output to the STDERR, while letting the original line'
+                                         ' piped to the STDOUT intact.', action='store_true')
+    group3.add_argument("--flush", help='When to write the output: `line` (every line), `never` (when the buffer is'
+                                        ' full) or the bounds like `50ms`, `64KiB` or `50ms,64KiB`. The output is flushed'
+                                        ' too when the input goes idle. By default `line` on a terminal, `50ms`'
+                                        ' when generating, otherwise a full buffer or an idle input.',
+                        type=flush_policy, metavar="POLICY")
+    group3.add_argument("--overflow-safe", help='Prevent `lines`, `numbers`, `text` variables to be available.'
+                                                ' Useful when handling an infinite input.', action='store_true')
+
+    group4 = parser.add_argument_group("Regular output")
+    group4.add_argument("--search", help='Equivalent to `search(COMMAND, s)`', action='store_true')
+    group4.add_argument("--match", help='Equivalent to `match(COMMAND, s)`', action='store_true')
+    group4.add_argument("--findall", help='Equivalent to `findall(COMMAND, s)`', action='store_true')
+    group4.add_argument("--sub", help='Equivalent to `sub(COMMAND, SUBSTITUTION, s)`', metavar="SUBSTITUTION")
+
+    group5 = parser.add_argument_group("Performance")
+    group5.add_argument("-j", "--jobs", help='Process the lines in NUM worker processes. Every worker runs the setup clause'
+                                             ' (the main process too, for the end clause) and processes the chunks'
+                                             ' of lines; variables `lines`, `numbers`, `text` are not available'
+                                             ' in the end clause. Global variables `i`, `S`, `L`, `D`, `C`'
+                                             ' are local to the chunk, then merged (summed, updated, extended).',
+                        type=positive_int, metavar="NUM")
+    group5.add_argument("--unordered", help='With --jobs or --concurrency, output the chunks or lines'
+                                            ' as soon as they are processed, not in the input order.',
+                        action='store_true')
+    group5.add_argument("--concurrency", help='Run the main clause for up to NUM lines at once in the threads,'
+                                              ' an awaitable result is awaited on the asyncio loop. Useful for'
+                                              ' I/O-bound clauses. The variables set in the clause are local to the line.'
+                                              ' Auto-imported `get` shares a pool of HTTP connections.',
+                        type=positive_int, metavar="NUM")
+    group5.add_argument("--batch", help='Run the main clause once per NUM lines (needs NumPy). Variable `S` holds the lines,'
+                                        ' `N` the NumPy array of numbers (NaN if not a number),'
+                                        ' `COLS[k]` the arrays of the columns (see --split).', type=positive_int,
+                        metavar="NUM")
+    group5.add_argument("--serve", help='Run a server listening on the Unix SOCKET (by default `$PZ_SERVER` or'
+                                        ' `$XDG_RUNTIME_DIR/pz-UID.sock`). The `extra/pz-client` runs every request'
+                                        ' in a forked process that has the modules already imported.',
+                        nargs="?", const=True, metavar="SOCKET")
+    group5.add_argument("--stats", help='Print the lines and bytes in and out, exceptions, peak memory and the time'
+                                        ' spent in the processing phases to the STDERR at the end'
+                                        ' (and every 10 seconds while running).', action='store_true')
+    group5.add_argument("--profile", help='Run the processing under cProfile and write the pstats dump to the FILE.',
+                        metavar="FILE")
+    group5.add_argument("--memo", help='Cache the main clause result (`s` and `skip`) of the distinct lines'
+                                       ' (see --memo-size). A repeated line is not processed again. Refused if'
+                                       ' the clause uses `i`, `S`, `L`, `D`, `C`, `count`, `lines`, `numbers`, `text`,'
+                                       ' `filename`, `file_count` or the streaming aggregators.', action='store_true')
+    group5.add_argument("--memo-size", help='Cache up to SIZE distinct lines, the least recently used are dropped'
+                                            ' (by default 10000, implies --memo).', type=int, metavar="SIZE")
+    group5.add_argument("--memo-file", help='Keep the --memo results in the SQLite FILE across the runs (implies --memo).',
+                        metavar="FILE")
+
+    group6 = parser.add_argument_group("Sorting and grouping")
+    group6.add_argument("--sort", help='Output the lines at the end, sorted by the KEY expression (by default the line'
+                                       ' itself). Variable `s` holds the line to be output.',
+                        nargs="?", const=True, metavar="KEY")
+    group6.add_argument("--group-by", help='Group the lines by the KEY expression (`s` holds the line to be output).'
+                                           ' At the end, output a row of the key and the aggregations per group.',
+                        metavar="KEY")
+    group6.add_argument("--agg", help='Aggregation of the --group-by groups: `count` (default), `sum(EXPR)`,'
+                                      ' `min(EXPR)`, `max(EXPR)`, `mean(EXPR)`, `first(EXPR)`, `last(EXPR)`.'
+                                      ' Might be repeated.', action="append", metavar="AGG")
+    group6.add_argument("--mem-limit", help='Memory for --sort and --group-by, the overflowing lines or groups are'
+                                            ' spilled to the temporary files and merged at the end.'
+                                            ' Ex: `512M` (default), `2G`.', type=parse_size, default="512M",
+                        metavar="SIZE")
+    # the FILE arguments may follow the flags, ex: `pz s -n 5 file.gz`
+    return getattr(parser, "parse_intermixed_args", parser.parse_args)()  # drop with Python3.6
+
+
+# evaluate command line arguments
+args = parse_args()
+logger.level = logger.ERROR if args.quiet else (logger.DEBUG if args.verbose else logger.WARNING)
+write_pipe = sys.stderr if args.stderr else sys.stdout
+skip_all = args.zero
+
+# custom functions
+whole_hint_printed = False
+match_class = re.match('', '').__class__ if sys.version_info < (3, 7) else re.Match  # drop with Python3.6
+flush_idle = False  # flush the output when the input goes idle, see `--flush`
+bulk_writers = []  # output buffers
+meter = None  # --stats instrumentation
+sorter = groups = None  # --sort and --group-by collectors
+memo = None  # --memo cache
+stages = []  # --chain clauses
+sort_code = group_code = None  # their key expressions
+agg_codes = []  # expressions of the --agg aggregations
+scope_variables = {"s", "n", "b", "r", "count", "text", "lines", "numbers", "skip", "i", "S", "L", "D", "C", "N",
+                   "COLS", "R", "P", "H", "K", "filename", "file_count"}
+JOB_CHUNK = 5000  # number of lines sent to a worker process at once in the `--jobs` mode
+BLOCK_SIZE = 1 << 16  # input is read by blocks
+BUFFER_SIZE = 1 << 16  # output is written by blocks
+READ_AHEAD = 16  # blocks of the FILE arguments read (and decompressed) ahead in the background
+# magic bytes of the compressed FILE arguments
+compressions = ((b"\x1f\x8b", "gzip"), (b"BZh", "bz2"), (b"\xfd7zXZ\x00", "lzma"), (b"\x28\xb5\x2f\xfd", "zstd"))
+SPILL_CHUNK = 1000  # items pickled at once to a --sort or --group-by temporary file
+trailing_whitespace = re.compile(rb"[ \t\r\x0b\x0c]+\n")  # what `bytes.rstrip` strips from the line end
+whitespace_ending = re.compile(rb"\n(?<=[ \t\r\x0b\x0c]\n)")  # the same but faster to search for, seeks newlines only
+# clause analysis (compiled at the start, a `--serve` request finds them in the cache of the `re` module)
+assignment = re.compile(r"(s|skip)\s*=[^=]")
+augmented_assignment = re.compile(r"(s|skip)\s*[+*]=")
+expression_assignment = re.compile(r"(s|skip)\s*=(?!=)(.*)", re.DOTALL)
+callable_expression = re.compile(r"(^|\.)[^\W\d]\w*$")
+
+
+class BulkWriter(io.RawIOBase):
+    """ Collect the output into a bytes buffer that is written to the pipe in large writes. """
+
+    def __init__(self, pipe, line_flush=False, size=BUFFER_SIZE):
+        super().__init__()
+        self.pipe = pipe  # binary stream
+        self.pending = bytearray()
+        self.line_flush = line_flush
+        self.size = size  # flush when the buffer reaches the size
+        self.lock = allocate_lock()  # the `--flush` interval thread flushes too
+        self.error = None  # the pipe failure met by that thread, raised in the main thread at the next write
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.pending += data
+        if self.line_flush or len(self.pending) >= self.size or self.error:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.error:
+            raise self.error
+        with self.lock:
+            if self.pending:
+                data = bytes(self.pending)  # another thread may append meanwhile
+                try:
+                    self.pipe.write(data)
+                    self.pipe.flush()
+                except OSError as e:
+                    self.error = e
+                    raise
+                finally:  # if the pipe is broken, do not try to write the data again
+                    del self.pending[:len(data)]
+
+
+class Meter:
+    """ Counters and the time spent in the processing phases, reported by the `--stats` flag.
+        Nothing is measured when the flag is off: the phase functions get wrapped only when the meter is installed.
+        Every moment is attributed to exactly one phase, the nested phase pauses the outer one. """
+    PHASES = ("setup", "imports", "read", "decode", "numbers", "clause", "output", "write", "end")
+
+    def __init__(self, interval=10):
+        from time import perf_counter
+        self.clock = perf_counter
+        self.times = Counter()  # phase → seconds
+        self.phase, self.mark = "setup", perf_counter()
+        self.bytes_read = self.bytes_written = self.lines_out = self.skipped = self.exceptions = 0
+        self.lines_in = None  # the lines of the main clause, once the `--chain` handed its `count` over
+        if interval:
+            from threading import Thread, Event
+            stopped = Event()
+            Thread(target=lambda: [self.report() for _ in iter(lambda: stopped.wait(interval), True)],
+                   daemon=True).start()
+
+    def switch(self, phase):
+        """ Attribute the time since the last switch to the current phase and start measuring the given one.
+            Return the previous phase. """
+        now = self.clock()
+        self.times[self.phase] += now - self.mark
+        previous, self.phase, self.mark = self.phase, phase, now
+        return previous
+
+    def timed(self, phase, function):
+        """ Wrap the function so that its run time is attributed to the phase. Other threads are not measured. """
+        switch, thread = self.switch, get_ident()
+
+        def wrapper(*args_):
+            if get_ident() != thread:
+                return function(*args_)
+            outer = switch(phase)
+            try:
+                return function(*args_)
+            finally:
+                switch(outer)
+        return wrapper
+
+    def read(self, blocks):
+        """ Wrap the input blocks to measure the bytes read and the time spent waiting for them. """
+        switch = self.switch
+        while True:
+            outer = switch("read")
+            block = next(blocks, None)
+            switch(outer)
+            if block is None:
+                return
+            self.bytes_read += len(block)
+            yield block
+
+    def install(self, namespace):
+        """ Wrap the functions of the phases in the namespace. """
+        for phase, name in (("imports", "import_name"), ("imports", "import_names"), ("decode", "split_block"),
+                            ("numbers", "get_number"), ("output", "learn_writer")):
+            namespace[name] = self.timed(phase, namespace[name])
+        choose_writer_, read_blocks_, read_files_, whole_blocks_ = (
+            namespace[name] for name in ("choose_writer", "read_blocks", "read_files", "whole_blocks"))
+        namespace["choose_writer"] = lambda sample: self.timed("output", choose_writer_(sample))
+        namespace["read_blocks"] = lambda *args_: self.read(read_blocks_(*args_))
+        namespace["read_files"] = lambda *args_: self.read(read_files_(*args_))
+        namespace["whole_blocks"] = lambda *args_: self.read(whole_blocks_(*args_))
+
+    def watch(self, raw):
+        """ Count the bytes and lines written by the BulkWriter and the time spent writing them to the pipe. """
+        flush = raw.flush
+
+        def wrapper():
+            self.bytes_written += len(raw.pending)
+            self.lines_out += raw.pending.count(b"\n")
+            flush()
+        raw.flush = self.timed("write", wrapper)
+
+    def report(self):
+        """ Print the counters and the time breakdown to the STDERR. """
+        times = self.times.copy()
+        times[self.phase] += self.clock() - self.mark
+        elapsed = sum(times.values()) or math.nan
+        lines_in = self.lines_in if self.lines_in is not None else globals().get("count") or 0
+        try:
+            import resource
+            memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == "darwin" else 2 ** 10)
+        except ImportError:  # not a Unix
+            memory = math.nan
+        phases = " | ".join(f"{phase} {times[phase]:.3f} s {times[phase] / elapsed:.0%}"
+                            for phase in self.PHASES if times[phase])
+        print(f"pz stats {elapsed:.3f} s: {lines_in:,} lines in ({lines_in / elapsed:,.0f}/s), {self.lines_out:,} out,"
+              f" {self.skipped:,} skipped, {self.exceptions:,} exceptions\n"
+              f"  {self.bytes_read / 2 ** 20:,.1f} MiB read ({self.bytes_read / 2 ** 20 / elapsed:,.1f} MiB/s),"
+              f" {self.bytes_written / 2 ** 20:,.1f} MiB written, peak memory {memory:,.1f} MiB\n"
+              + (f"  memo {memo.hits:,} hits, {memo.misses:,} misses\n" if memo else "")
+              + f"  {phases}", file=sys.__stderr__, flush=True)
+
+
+class Lines:
+    """ Lines stored in a single buffer while the input is being processed.
+        (A `str` per line would take much more memory than the line itself.)
+        A clause gets them as a real list, see `to_list`. """
+
+    def __init__(self):
+        self.buffer = bytearray()  # newline-terminated lines
+        self.offsets = array("q", [0])  # line `i` starts at `offsets[i]`
+        self.multiline = False  # whether a line contains a newline (then lines cannot be split at once)
+
+    def append(self, line):
+        if "\n" in line:
+            self.multiline = True
+        self.buffer += line.encode()
+        self.buffer += b"\n"
+        self.offsets.append(len(self.buffer))
+
+    def text(self):
+        """ All lines joined by a newline. """
+        return str(memoryview(self.buffer)[:-1], "utf-8")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _decode(self, start, end):
+        if self.multiline:
+            view = memoryview(self.buffer)
+            return [str(view[self.offsets[i]:self.offsets[i + 1] - 1], "utf-8") for i in range(start, end)]
+        # decode multiple lines at once
+        return str(memoryview(self.buffer)[self.offsets[start]:self.offsets[end] - 1], "utf-8").split("\n")
+
+    def to_list(self):
+        """ Return the lines as a list. The buffer is freed from the end meanwhile so that the memory does not double. """
+        chunks = []
+        end = len(self)
+        while end:
+            start = max(end - JOB_CHUNK, 0)
+            chunks.append(self._decode(start, end))
+            del self.buffer[self.offsets[start]:]
+            del self.offsets[start + 1:]
+            end = start
+        result = []
+        while chunks:
+            result += chunks.pop()
+        return result
+
+
+class Numbers:
+    """ Numbers stored in a typed array while the input is being processed. Integers are kept as int64
+        until a float comes (then a double array is used while remembering which items were integers).
+        A big integer that would not fit makes the numbers fall back to a list.
+        A clause gets them as a real list, see `to_list`. """
+
+    def __init__(self):
+        self.data = array("q")
+        self.integers = None  # when promoted to double, marks the items that were integers
+
+    def append(self, value):
+        if self.integers is not None and type(value) is int and abs(value) > 2 ** 53:
+            self.data, self.integers = self.to_list(), None  # a double would lose the precision
+        try:
+            self.data.append(value)
+        except TypeError:
+            if type(value) is float:  # a float cannot get into the int64 array
+                self.data, self.integers = array("d", self.data), bytearray(b"\x01") * len(self.data)
+            else:
+                self.data, self.integers = self.to_list(), None
+            return self.append(value)
+        except OverflowError:
+            self.data = list(self.data)
+            return self.append(value)
+        if self.integers is not None:
+            self.integers.append(type(value) is not float)
+
+    def __len__(self):
+        return len(self.data)
+
+    def to_list(self):
+        """ Return the numbers as a list. The array is freed from the end meanwhile. """
+        if isinstance(self.data, list):
+            return self.data
+        chunks = []
+        end = len(self)
+        while end:
+            start = max(end - JOB_CHUNK, 0)
+            if self.integers is None:
+                chunks.append(self.data[start:end].tolist())
+            else:
+                chunks.append([int(value) if integer else value
+                               for value, integer in zip(self.data[start:end], self.integers[start:end])])
+                del self.integers[start:]
+            del self.data[start:]
+            end = start
+        result = []
+        while chunks:
+            result += chunks.pop()
+        return result
+
+
+def as_lists(code=None):
+    """ Convert the `lines` and `numbers` from the compact storage to the lists a clause gets.
+        Given the code, only the ones it refers to (ex: not `lines` when the end clause uses just the `text`). """
+    names = code_names(code) if code else None
+    for name in ("lines", "numbers"):
+        if (names is None or name in names) and isinstance(globals().get(name), (Lines, Numbers)):
+            globals()[name] = globals()[name].to_list()
+
+
+class Aggregator:
+    """ Streaming aggregator: whatever long the input is, it keeps a constant memory. """
+
+    def update(self, iterable):
+        for value in iterable:
+            self.add(value)
+
+    def result(self):
+        raise NotImplementedError
+
+    def __str__(self):
+        return str(self.result())
+
+    def __repr__(self):
+        return repr(self.result())
+
+
+class Stats(Aggregator):
+    """ Running count, sum, mean, variance, minimum and maximum of the numbers (Welford's algorithm). """
+
+    def __init__(self, iterable=()):
+        self.count = 0
+        self.sum = 0
+        self.mean = 0.0
+        self.squares = 0.0  # sum of the squared differences from the mean
+        self.min = self.max = None
+        self.update(iterable)
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.squares += delta * (value - self.mean)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def variance(self):
+        """ Sample variance """
+        return self.squares / (self.count - 1) if self.count > 1 else math.nan
+
+    @property
+    def stdev(self):
+        return math.sqrt(self.variance)
+
+    def merge(self, other):
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.squares += other.squares + delta * delta * self.count * other.count / count
+        self.mean += delta * other.count / count
+        self.count, self.sum = count, self.sum + other.sum
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def result(self):
+        return [(name, getattr(self, name)) for name in ("count", "sum", "mean", "stdev", "min", "max")]
+
+
+class Quantiles(Aggregator):
+    """ Approximate quantiles of the numbers (KLL sketch). The precision grows with `k`,
+        the sketch holds about `3 * k` numbers. """
+
+    def __init__(self, iterable=(), k=200):
+        from random import Random
+        self.k = k
+        self.count = 0
+        self.compactors = [[]]  # items of the compactor `h` stand for 2**h items each
+        self.size = 0
+        self.max_size = self._capacity(0)
+        self.random = Random(0)  # compact the odd or the even items
+        self.update(iterable)
+
+    def _capacity(self, height):
+        return int(math.ceil(self.k * (2 / 3) ** (len(self.compactors) - height - 1))) + 1
+
+    def _compress(self):
+        for height, items in enumerate(self.compactors):
+            if len(items) >= self._capacity(height):
+                if height + 1 == len(self.compactors):
+                    self.compactors.append([])
+                    self.max_size = sum(self._capacity(h) for h in range(len(self.compactors)))
+                items.sort()
+                leftover = [items.pop()] if len(items) % 2 else []  # an odd item stays at the current height
+                self.compactors[height + 1].extend(items[self.random.getrandbits(1)::2])
+                items[:] = leftover
+                self.size = sum(len(x) for x in self.compactors)
+                if self.size < self.max_size:
+                    break
+
+    def add(self, value):
+        self.count += 1
+        self.compactors[0].append(value)
+        self.size += 1
+        if self.size >= self.max_size:
+            self._compress()
+
+    def merge(self, other):
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+        for items, others in zip(self.compactors, other.compactors):
+            items.extend(others)
+        self.count += other.count
+        self.max_size = sum(self._capacity(h) for h in range(len(self.compactors)))
+        self.size = sum(len(x) for x in self.compactors)
+        while self.size >= self.max_size:
+            self._compress()
+
+    def quantile(self, q=0.5):
+        """ Return the number that is greater than the `q` fraction of the numbers. The median by default. """
+        items = sorted((value, 1 << height) for height, items in enumerate(self.compactors) for value in items)
+        if not items:
+            return None
+        rank = q * sum(weight for _, weight in items)
+        cumulative = 0
+        for value, weight in items:
+            cumulative += weight
+            if cumulative > rank:
+                return value
+        return items[-1][0]
+
+    def result(self):
+        return [(q, self.quantile(q)) for q in (0.25, 0.5, 0.75, 0.9, 0.99)]
+
+
+class Distinct(Aggregator):
+    """ Approximate count of the distinct items (HyperLogLog). The standard error is about 1 %. """
+    PRECISION = 14
+    MASK = (1 << 64) - 1
+
+    def __init__(self, iterable=()):
+        self.registers = bytearray(1 << self.PRECISION)
+        self.update(iterable)
+
+    def add(self, value):
+        # Python hash of an int is the int itself, mix the bits (splitmix64 finalizer)
+        x = hash(value) & self.MASK
+        x = (x ^ (x >> 30)) * 0xBF58476D1CE4E5B9 & self.MASK
+        x = (x ^ (x >> 27)) * 0x94D049BB133111EB & self.MASK
+        x ^= x >> 31
+        index = x >> (64 - self.PRECISION)
+        rank = 64 - self.PRECISION - (x & ((1 << (64 - self.PRECISION)) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def result(self):
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:  # small range correction
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+
+class TopK(Aggregator):
+    """ Approximate most common items (space-saving algorithm). At most `capacity` items are counted,
+        a new item replaces the least common one while inheriting its count. """
+
+    def __init__(self, iterable=(), capacity=1000):
+        self.capacity = capacity
+        self.counts = {}
+        self.heap = []  # (count, order, item) candidates for the least common item
+        self.order = 0
+        self.update(iterable)
+
+    def add(self, item):
+        counts = self.counts
+        if item in counts:
+            counts[item] += 1
+        elif len(counts) < self.capacity:
+            counts[item] = 1
+        else:
+            import heapq
+            heap = self.heap
+            if not heap:
+                heap[:] = [(c, self.order + k, x) for k, (x, c) in enumerate(counts.items())]
+                self.order += len(heap)
+                heapq.heapify(heap)
+            while True:
+                c, order, victim = heapq.heappop(heap)
+                if counts[victim] == c:
+                    break
+                heapq.heappush(heap, (counts[victim], order, victim))  # the count has grown since
+            del counts[victim]
+            counts[item] = c + 1
+            heapq.heappush(heap, (c + 1, self.order, item))
+            self.order += 1
+
+    def merge(self, other):
+        for item, c in other.counts.items():
+            self.counts[item] = self.counts.get(item, 0) + c
+        self.counts = dict(self.most_common(self.capacity))
+        self.heap = []
+
+    def most_common(self, n=None):
+        """ List of the (item, count) tuples, the most common first. """
+        return sorted(self.counts.items(), key=lambda x: x[1], reverse=True)[:n]
+
+    def result(self):
+        return self.most_common(10)
+
+
+# streaming aggregators in the user scope, fed by every number (n) or line (s) if referenced
+aggregators = {"R": (Stats, "n"), "P": (Quantiles, "n"), "H": (Distinct, "s"), "K": (TopK, "s")}
+
+
+def sort_key(value):
+    """ Total order of the keys of different types: the numbers, the strings, the bytes, the tuples (compared
+        item by item), the other objects (by their type name), the None last. """
+    kind = type(value)
+    if kind is str:
+        return 1, value
+    if kind is int or kind is float or kind is bool:
+        return 0, value
+    if kind is tuple or kind is list:
+        return 3, tuple(map(sort_key, value))
+    if value is None:
+        return 5, 0
+    if kind is bytes:
+        return 2, value
+    return 4, kind.__name__, value
+
+
+def item_key(item):
+    """ Sort key of the (key, value) item, see `sort_key`. """
+    return sort_key(item[0])
+
+
+def spill(items):
+    """ Sort the (key, value) items and pickle them to a temporary file by chunks. Return the file. """
+    import pickle
+    from tempfile import TemporaryFile
+    items.sort(key=item_key)
+    f = TemporaryFile()
+    for i in range(0, len(items), SPILL_CHUNK):
+        pickle.dump(items[i:i + SPILL_CHUNK], f, pickle.HIGHEST_PROTOCOL)
+    f.seek(0)
+    logger.debug(f"Spilled {len(items)} items to a temporary file")
+    return f
+
+
+def unspill(f):
+    """ Yield the items of the temporary file, loaded by chunks. """
+    import pickle
+    with f:
+        while True:
+            try:
+                chunk = pickle.load(f)
+            except EOFError:
+                return
+            yield from chunk
+
+
+class ExternalSort:
+    """ Sort the (key, value) items in a bounded memory (`--sort`). When the items exceed the memory limit,
+        they are sorted and spilled to a temporary file. The spilled runs are k-way merged when iterated. """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.items = []
+        self.size = 0  # estimated memory of the items
+        self.runs = []  # temporary files
+
+    def add(self, key, value):
+        self.items.append((key, value))
+        self.size += sys.getsizeof(value) + (0 if key is value else sys.getsizeof(key)) + 64  # + the tuple
+        if self.size > self.limit:
+            self.runs.append(spill(self.items))
+            self.items, self.size = [], 0
+
+    def __iter__(self):
+        """ Yield the values in the order of the keys. The values of the same key keep the input order. """
+        items, self.items = self.items, []
+        items.sort(key=item_key)
+        if self.runs:
+            import heapq
+            items = heapq.merge(*map(unspill, self.runs), items, key=item_key)
+        return (value for _, value in items)
+
+
+# `--agg` functions: (start the partial aggregate with a value, add a value, merge two partial aggregates, result)
+group_aggregations = {
+    "count": (lambda _: 1, lambda a, _: a + 1, lambda a, b: a + b, None),
+    "sum": (None, lambda a, v: a + v, lambda a, b: a + b, None),
+    "min": (None, min, min, None),
+    "max": (None, max, max, None),
+    "mean": (lambda v: (v, 1), lambda a, v: (a[0] + v, a[1] + 1), lambda a, b: (a[0] + b[0], a[1] + b[1]),
+             lambda a: a[0] / a[1]),
+    "first": (None, lambda a, _: a, lambda a, _: a, None),
+    "last": (None, lambda _, v: v, lambda _, b: b, None),
+}
+
+
+def parse_aggregation(value):
+    """ Parse the `--agg` aggregation like `count` or `sum(n)`. Return (name, compiled expression or None). """
+    m = re.fullmatch(r"\s*(\w+)\s*(?:\((.*)\))?\s*", value, re.DOTALL)
+    if not m or m[1] not in group_aggregations or (m[2] is None) != (m[1] == "count"):
+        raise ValueError(f"unknown aggregation '{value}'")
+    return m[1], m[2] and builtins.compile(m[2], "<agg>", "eval")
+
+
+class ExternalGroups:
+    """ Aggregate the values by the key in a bounded memory (`--group-by`). When the groups exceed the memory limit,
+        their partial aggregates are sorted by the key and spilled to a temporary file. The spilled runs
+        are k-way merged when iterated, the partial aggregates of the same key are merged then. """
+
+    def __init__(self, names, limit):
+        self.starts, self.adds, self.merges, self.results = zip(*(group_aggregations[name] for name in names))
+        self.limit = limit
+        self.groups = {}
+        self.size = 0  # estimated memory of the groups
+        self.runs = []  # temporary files
+
+    def add(self, key, values):
+        state = self.groups.get(key)
+        if state is None:
+            self.groups[key] = [start(v) if start else v for start, v in zip(self.starts, values)]
+            self.size += sys.getsizeof(key) + 100 + 64 * len(values)  # + the dict entry and the partial aggregates
+            if self.size > self.limit:
+                self.runs.append(spill(list(self.groups.items())))
+                self.groups, self.size = {}, 0
+        else:
+            for i, add in enumerate(self.adds):
+                state[i] = add(state[i], values[i])
+
+    def merged(self, items):
+        """ Merge the partial aggregates of the neighbouring items of the same key. """
+        key = state = None
+        for key_, state_ in items:
+            if state is not None and key_ == key:
+                state = [merge(a, b) for merge, a, b in zip(self.merges, state, state_)]
+            else:
+                if state is not None:
+                    yield key, state
+                key, state = key_, state_
+        if state is not None:
+            yield key, state
+
+    def __iter__(self):
+        """ Yield the rows of the key (or the key items if a tuple) and the aggregations in the order of the keys. """
+        items, self.groups = list(self.groups.items()), {}
+        items.sort(key=item_key)
+        if self.runs:
+            import heapq
+            items = self.merged(heapq.merge(*map(unspill, self.runs), items, key=item_key))
+        for key, state in items:
+            results = tuple(result(a) if result else a for result, a in zip(self.results, state))
+            yield (*key, *results) if type(key) is tuple else (key, *results)
+
+
+class Memo:
+    """ LRU cache of the main clause results `(s, skip)` keyed by the input line (`--memo`).
+        Only the immutable results are cached (a generator would be exhausted by the first output).
+        With the `--memo-file`, the results are kept in an SQLite file across the runs too. """
+    TYPES = (str, bytes, int, float, bool, tuple, type(None))
+
+    def __init__(self, size, path=None, clause=""):
+        self.size = size
+        self.cache = OrderedDict()
+        self.hits = self.misses = 0
+        self.db = None
+        if path:
+            import pickle
+            import sqlite3
+            self.pickle = pickle
+            self.db = sqlite3.connect(path)
+            self.db.execute("CREATE TABLE IF NOT EXISTS memo (clause TEXT, line TEXT, result BLOB,"
+                            " PRIMARY KEY (clause, line))")
+            self.clause = clause  # the results are stored per the clause text (and what else it depends on)
+            self.pending = []  # results to be stored
+
+    def get(self, line):
+        """ Return the cached result or None. """
+        cache = self.cache
+        result = cache.get(line)
+        if result is not None:
+            cache.move_to_end(line)
+        elif self.db:
+            row = self.db.execute("SELECT result FROM memo WHERE clause = ? AND line = ?",
+                                  (self.clause, line)).fetchone()
+            if row:
+                result = self.pickle.loads(row[0])
+                self.remember(line, result)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def put(self, line, result):
+        if type(result[0]) not in self.TYPES or type(result[1]) not in self.TYPES:
+            return
+        self.remember(line, result)
+        if self.db:
+            self.pending.append((self.clause, line, self.pickle.dumps(result)))
+            if len(self.pending) >= SPILL_CHUNK:
+                self.commit()
+
+    def remember(self, line, result):
+        self.cache[line] = result
+        if len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+
+    def commit(self):
+        self.db.executemany("INSERT OR REPLACE INTO memo VALUES (?, ?, ?)", self.pending)
+        self.db.commit()
+        self.pending.clear()
+
+    def close(self):
+        logger.info(f"Memo: {self.hits} hits, {self.misses} misses")
+        if self.db:
+            self.commit()
+            self.db.close()
+
+
+def redirect_output(stdout, stderr, line_flush=False, size=BUFFER_SIZE, interval=None):
+    """ Let STDOUT (and with --stderr the STDERR) pass through the BulkWriter. As the user clause
+        printing to `sys.stdout` writes to the same buffer, the order of the output is kept.
+        With the interval, a thread flushes the buffers periodically. """
+    global write_pipe, bulk_writers
+    sys.stdout = io.TextIOWrapper(BulkWriter(stdout, line_flush, size), sys.stdout.encoding, sys.stdout.errors,
+                                  write_through=True)
+    bulk_writers = [sys.stdout.buffer]
+    if args.stderr:
+        sys.stderr = io.TextIOWrapper(BulkWriter(stderr, line_flush, size), sys.stderr.encoding, sys.stderr.errors,
+                                      write_through=True)
+        logger.stream = sys.stderr  # keep the order of the warnings
+        bulk_writers.append(sys.stderr.buffer)
+    write_pipe = sys.stderr if args.stderr else sys.stdout
+    if interval:
+        from threading import Thread
+        from time import sleep
+
+        def flush_periodically():
+            try:
+                while True:
+                    sleep(interval)
+                    for raw in bulk_writers:
+                        raw.flush()
+            except (OSError, ValueError):  # ex: broken or closed pipe
+                pass
+        Thread(target=flush_periodically, daemon=True).start()
+
+
+def flush_if_idle(stream):
+    """ Flush the pending output when the input has no data ready (the next read would block)
+        so that the lines do not wait in the buffer during the quiet periods of a stream. """
+    if any(raw.pending for raw in bulk_writers):
+        import select
+        try:
+            ready = select.select([stream], [], [], 0)[0]
+        except (OSError, ValueError):  # ex: a stream without a file descriptor
+            return
+        if not ready:
+            for raw in bulk_writers:
+                raw.flush()
+
+
+def write(v):
+    """ Print either bytes or string. Bytes are not printed in the Python b-form: b'string' but raw. """
+    if type(v) is not bytes:
+        v = str(v).encode(write_pipe.encoding, write_pipe.errors)
+    write_pipe.buffer.write(v + b'\n')
+
+
+def decode_line(b):
+    """ Return the line as bytes and str. """
+    try:
+        return b, b.decode()
+    except UnicodeError:
+        logger.warning(f"Cannot parse line correctly: {b}")
+        return b, b.decode(errors="replace")
+
+
+def split_block(block):
+    """ Split a block of newline-terminated lines at once. Decode it at once, if that fails, line by line.
+        Return the iterable of (bytes, str) line pairs, stripped from the trailing whitespace. """
+    if whitespace_ending.search(block):
+        block = trailing_whitespace.sub(b"\n", block)
+    try:
+        str_lines = block.decode().split("\n")
+    except UnicodeError:
+        return map(decode_line, block.split(b"\n")[:-1])
+    del str_lines[-1]
+    if not need_b:  # spare splitting the bytes when `b` is not used
+        return zip(repeat(None), str_lines)
+    return zip(block.split(b"\n"), str_lines)
+
+
+def read_whole(stream):
+    """ Return the whole input and the position it starts at. A regular file gets memory-mapped. """
+    try:
+        fd = stream.fileno()
+        if stat.S_ISREG(os.fstat(fd).st_mode) and os.fstat(fd).st_size:
+            import mmap
+            return mmap.mmap(fd, 0, access=mmap.ACCESS_READ), os.lseek(fd, 0, os.SEEK_CUR)
+    except (OSError, ValueError):  # ex: not a real file
+        pass
+    return stream.read(), 0
+
+
+def read_whole_files(paths):
+    """ Return the whole contents of the files and the position it starts at. A single regular file
+        gets memory-mapped, otherwise the files are read (and decompressed) and joined. """
+    if len(paths) == 1 and paths[0] != "-":
+        try:
+            with open(paths[0], "rb") as f:
+                if stat.S_ISREG(os.fstat(f.fileno()).st_mode) and open_file(f) is f:
+                    os.lseek(f.fileno(), 0, os.SEEK_SET)  # the peeked bytes are buffered
+                    return read_whole(f)
+        except OSError:  # reported when read
+            pass
+    return b"".join(read_files(paths)), 0
+
+
+def whole_blocks(whole, start, end):
+    """ Cut the whole input (bytes or mmap) to the blocks of newline-terminated lines.
+        Newlines are unified so that the lines split as `bytes.splitlines` would. """
+    pos = start
+    while pos < end:
+        cut = whole.rfind(b"\n", pos, min(pos + BLOCK_SIZE, end)) + 1
+        if not cut:  # a long line spans over multiple blocks
+            cut = whole.find(b"\n", pos + BLOCK_SIZE, end) + 1 or end
+        block = whole[pos:cut]
+        if cut == end:
+            block += b"\n"
+        if b"\r" in block:  # `splitlines` treats `\r` as a newline too
+            block = block.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        yield block
+        pos = cut
+
+
+def read_blocks(stream):
+    """ Read the stream in large blocks of newline-terminated lines. """
+    rest = b""
+    while True:
+        if flush_idle:
+            flush_if_idle(stream)
+        block = stream.read1(BLOCK_SIZE)  # do not wait for the whole block, the stream may be a slow pipe
+        if not block:
+            if rest:
+                yield rest + b"\n"
+            return
+        cut = block.rfind(b"\n") + 1
+        if cut:
+            yield rest + block[:cut]
+            rest = block[cut:]
+        else:  # a long line spans over multiple blocks
+            rest += block
+
+
+def expand_files(patterns):
+    """ Expand the glob patterns of the FILE arguments, sorted. A pattern matching nothing is kept
+        so that its reading fails with a message. """
+    from glob import glob
+    for pattern in patterns:
+        if re.search(r"[*?[]", pattern):
+            yield from sorted(glob(pattern, recursive=True)) or [pattern]
+        else:
+            yield pattern
+
+
+def open_file(f):
+    """ Return the stream of the binary file, decompressed if it starts with the gzip, bz2, xz or zstd magic bytes. """
+    head = f.peek(6)[:6]
+    for magic, module in compressions:
+        if head.startswith(magic):
+            break
+    else:
+        return f
+    if module != "zstd":
+        return __import__(module).open(f)
+    try:  # Python 3.14
+        from compression import zstd
+        return zstd.open(f)
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("The zstd file needs Python 3.14 or zstandard: pip3 install zstandard") from None
+    return zstandard.ZstdDecompressor().stream_reader(f)
+
+
+def file_blocks(stream):
+    """ Read the file in large blocks of newline-terminated lines. """
+    # an uncompressed stream does not wait for the whole block, `-` may be a slow pipe
+    read = stream.read1 if isinstance(stream, io.BufferedReader) else stream.read
+    rest = b""
+    while True:
+        block = read(BLOCK_SIZE)
+        if not block:
+            if rest:
+                yield rest + b"\n"
+            return
+        cut = block.rfind(b"\n") + 1
+        if cut:
+            yield rest + block[:cut]
+            rest = block[cut:]
+        else:  # a long line spans over multiple blocks
+            rest += block
+
+
+def read_files(paths):
+    """ Read the files one after another in large blocks of newline-terminated lines. A background thread reads
+        (and decompresses) a few blocks ahead so that it overlaps with the processing.
+        Set the `filename` and reset the `file_count` when the lines of the next file come. """
+    global filename, file_count
+    from queue import Queue
+    from threading import Thread
+    queue = Queue(READ_AHEAD)
+
+    def read():
+        for path in paths:
+            f = sys.stdin.buffer if path == "-" else None
+            try:
+                f = f or open(path, "rb")
+                queue.put(path)  # a str marks the start of the file
+                for block in file_blocks(open_file(f)):
+                    queue.put(block)
+            except Exception as e:  # ex: a missing file, a corrupted archive
+                queue.put((path, e))
+            finally:
+                if f and path != "-":
+                    f.close()
+        queue.put(None)
+
+    Thread(target=read, daemon=True).start()
+    while True:
+        if flush_idle and queue.empty():  # the next block is not ready, see `flush_if_idle`
+            for raw in bulk_writers:
+                raw.flush()
+        item = queue.get()
+        if type(item) is bytes:
+            yield item
+        elif type(item) is str:
+            filename, file_count = item, 0
+        elif item:
+            logger.error(f"Cannot read {item[0]}: {item[1]}")
+        else:
+            return
+
+
+def split_blocks(blocks):
+    """ Split the blocks to the lines in bulk. Yield (bytes, str) line pairs. """
+    for block in blocks:
+        yield from split_block(block)
+
+
+def split_records(blocks):
+    """ Split the blocks to the lines and parse the lines of a block to the records at once, see `record_parser`.
+        Yield (bytes, str, record) line triples. """
+    for block in blocks:
+        columns = tuple(zip(*split_block(block)))  # (bytes lines, str lines)
+        if columns:
+            yield from zip(*columns, parse_records(columns[1]))
+
+
+def record_parser():
+    """ Return the function that parses a list of lines to the list of the records `r` (`--csv`, `--jsonl`, `--split`)
+        by the C machinery of the `csv` and `json` modules, or None if no record mode is on. """
+    if args.csv:
+        import csv
+        options = {"delimiter": args.split} if args.split else {}
+
+        def parse(lines):
+            records = list(map(tuple, csv.reader(lines, **options)))
+            if len(records) != len(lines):  # a quoted field continued on the next line, parse the lines one by one
+                records = [tuple(next(csv.reader((line,), **options), ())) for line in lines]
+            return records
+    elif args.jsonl:
+        import json
+
+        def parse_line(line):
+            try:
+                return json.loads(line)
+            except ValueError:
+                if line:
+                    logger.warning(f"Cannot parse the JSON line: {line}")
+                return None
+
+        decode = json.JSONDecoder().raw_decode  # skips the checks `json.loads` does on every call
+
+        def parse_record(line):
+            try:
+                record, end = decode(line)
+                if end == len(line):  # the record spans exactly the line
+                    return record
+            except ValueError:
+                pass
+            return parse_line(line)  # ex: a surrounding whitespace, an invalid line or more values like `1, 2`
+
+        def parse(lines):
+            return list(map(parse_record, lines))
+    elif args.split:
+        delimiter = args.split
+
+        def parse(lines):
+            return list(map(tuple, map(str.split, lines, repeat(delimiter))))
+    else:
+        return None
+    return parse
+
+
+def record_formatter():
+    """ Return the function that formats a tuple (or another iterable) output line:
+        as a CSV row (`--csv`), JSON (`--jsonl`) or the values joined by the `--split` delimiter or by a tab. """
+    if args.csv:
+        import csv
+
+        class Row:  # `writerow` returns what `write` returns, here the formatted row itself
+            write = str
+        return csv.writer(Row, lineterminator="", **({"delimiter": args.split} if args.split else {})).writerow
+    if args.jsonl:
+        import json
+        encode = json.JSONEncoder(ensure_ascii=False, default=str).encode
+        return lambda line: encode(line if isinstance(line, (dict, tuple, list)) else list(line))
+    delimiter = args.split or "\t"
+    return lambda line: delimiter.join(map(str, line))
+
+
+@contextmanager
+def auto_import():
+    """ If line processing fails with a NameError, check """
+    try:
+        yield
+    except NameError as e:
+        resolve_name_error(e)
+
+
+def resolve_name_error(e):
+    """ Import the name the NameError complains about. Re-raise if that is not possible. """
+    global whole_hint_printed
+    name = re.match(r"name '(.*?)' is not defined", str(e))[1]
+    if name:
+        # Import anything on the fly (saved performance when loaded)
+        if name == "text":
+            if not whole_hint_printed:
+                logger.warning("Did you not forget to use --whole to access `text`?")
+                whole_hint_printed = True
+            raise e
+        elif name in ("numbers", "lines"):
+            if not whole_hint_printed and args.overflow_safe:
+                logger.warning("The flag --overflow-safe suppress `lines` and `numbers`."
+                               " Streaming aggregators `R`, `P`, `H`, `K` are available instead.")
+                whole_hint_printed = True
+            elif not whole_hint_printed and args.jobs:
+                logger.warning("The flag --jobs suppress `lines` and `numbers`.")
+                whole_hint_printed = True
+            raise e
+        elif not import_name(name):
+            raise e
+
+
+def import_name(name):
+    """ Import the name to the global scope if available. Return False if not available. """
+    if name in available_names:
+        module = available_names[name]
+        logger.info(f"Importing {name} from {module}")
+        # ex sleep = getattr(module "time", "sleep")
+        globals()[name] = getattr(__import__(module), name)
+    elif name in available_modules:
+        logger.info(f"Importing {name}")
+        globals()[name] = __import__(name)
+    else:
+        for module in star_modules:
+            if name in star_names(module):
+                globals()[name] = getattr(sys.modules[module], name)
+                break
+        else:
+            return False
+    return True
+
+
+def star_names(module):
+    """ Names the `from module import *` would bring. """
+    module = sys.modules[module]
+    return getattr(module, "__all__", None) or [x for x in dir(module) if not x.startswith("_")]
+
+
+def global_names(code, candidates):
+    """ Return the sets of the candidate names the code object (and the nested ones) loads from
+        and stores to the global scope. Unlike `code.co_names`, attributes do not count (ex: `get` in `D.get(s)`). """
+    loaded, stored = set(), set()
+    if candidates.intersection(code.co_names):
+        import dis
+        for instruction in dis.get_instructions(code):
+            if instruction.argval in candidates:
+                if instruction.opname in ("LOAD_NAME", "LOAD_GLOBAL"):
+                    loaded.add(instruction.argval)
+                elif instruction.opname in ("STORE_NAME", "STORE_GLOBAL"):
+                    stored.add(instruction.argval)
+    for const in code.co_consts:
+        if isinstance(const, type(code)):
+            loaded_, stored_ = global_names(const, candidates)
+            loaded |= loaded_
+            stored |= stored_
+    return loaded, stored
+
+
+def import_names(codes, everything=False):
+    """ Import the available names the clauses load ahead, so that no line gets reprocessed because of a NameError
+        (which repeats the side effects of the clause). Names the clauses define themselves are skipped
+        (ex: `--setup "from time import sleep"`). Bring all the star module names if `everything`.
+        The NameError-driven `auto_import` stays for the names built dynamically (ex: `eval`). """
+    star = {name for module in star_modules for name in star_names(module)}
+    candidates = (available_names.keys() | available_modules | star) - scope_variables - globals().keys()
+    loaded, stored = set(), set()
+    for code in codes:
+        if not isinstance(code, str):
+            loaded_, stored_ = global_names(code, candidates)
+            loaded |= loaded_
+            stored |= stored_
+    if everything:
+        loaded |= star & candidates
+    for name in sorted(loaded - stored):
+        try:
+            # ex: `compile` stands for `re.compile` and `pow` for `math.pow`, as they were star-imported before
+            import_name(name)
+        except ImportError as e:  # let the clause fail as usual
+            logger.debug(f"Cannot import {name}: {e}")
+
+
+def try_argument(callable_, argument, var, cmd="main", rewrite=True):
+    """ Try to pass an argument to a callable. Returns False if TypeError happened.
+        If `rewrite`, the clause is changed to pass the argument itself for the next lines. """
+    t = f"attempt to use `{var}` as the callable parameter in the {cmd} clause: {command[cmd]}({argument})"
+    try:
+        output(callable_(argument))
+        if rewrite:
+            command[cmd] += f"({var})"
+            compile_command(cmd)
+            determine_needs()
+    except TypeError as e:
+        logger.debug(f"Failed {t} with: {e}")
+        return False
+    else:
+        logger.debug(f"Successful {t}")
+        return True
+
+
+def output(line, final_round=None):
+    """ output one or more lines """
+    global tried_to_correct_callable
+    if isinstance(line, match_class):
+        # replace with the tuple of the groups or whole matched string (if no group matched)
+        line = line.groups() or line.group(0)
+    elif type(line) is not str and getattr(line, "ndim", None) is not None:  # NumPy array or scalar
+        line = [tuple(row) for row in line.tolist()] if line.ndim > 1 else line.tolist()
+    elif isinstance(line, Aggregator):
+        line = line.result()
+    if line:  # empty string makes no output
+        if isinstance(line, (str, bytes)):
+            write(line)
+        elif isinstance(line, list):  # list is output as multiple lines
+            [output(el) for el in line]
+        elif isinstance(line, Iterable):  # tuple or generator (but not a string) gets joined
+            write(format_record(line))
+        elif isinstance(line, Callable):  # tuple or generator (but not a string) gets joined
+            # Only a bare callable clause gets rewritten (ex: `pz sqrt`). Otherwise, the callable is resolved
+            # for this line only (ex: `pz 'str if n == 1 else s'`).
+            cmd = "end" if final_round else "main"
+            rewrite = cmd in compiled and bare_callable(command[cmd], compiled[cmd][1])
+            try:
+                result = line()
+            except TypeError:
+                if rewrite and tried_to_correct_callable and not final_round:
+                    # this it not the first line of the main command nor the `--end` clause,
+                    # we have already been there without success
+                    raise
+                tried_to_correct_callable = tried_to_correct_callable or rewrite
+                # ex: `| pz webbrowser.open` -> `| pz webbrowser.open(s)`
+                # ex: `sqrt() takes exactly one argument (0 given)`
+                # ex: `open() missing required argument 'file' (pos 1)'` (build-in open)
+                # ex: `open() missing 1 required positional argument: 'url'` (webbrowser.open)
+                # Unfortunately, there is no certain way to determine the wanted type.
+                # The wording of TypeError exceptions specifying the type vary.
+                # The best we have is to use the inspect module to get the annotation or the parameter name.
+                # We content to try it multiple things to pass as an argument.
+                attempts = []
+                if not final_round:
+                    attempts.append((original_line, "s"))
+                    if need_numbers:
+                        attempts.append((numbers, "numbers"))
+                    else:
+                        logger.debug("Since `numbers` are not populated, we will not try them.")
+                    number = n if need_n else get_number(original_line)
+                    if number is not None:
+                        # ex: echo  5 | pz sqrt | pz round
+                        attempts.append((number, "n"))
+                    import inspect
+                    try:
+                        param = list(inspect.signature(line).parameters.values())[0]
+                        if param.name != "iterable":
+                            # ex: pz b64encode += (s.encode('utf-8'))
+                            logger.debug("Let's try `s.encode('utf-8')` automatically too.")
+                            attempts.append((original_line.encode("utf-8"), "s.encode('utf-8')"))
+                    except ValueError:  # ex: `set.add` raises no signature found
+                        pass
+                else:  # we are in the `--end` clause, original_line is empty, we use `lines` or `numbers` instead
+                    as_lists()
+                    if need_numbers and need_lines and len(numbers) == len(lines):
+                        attempts.append((numbers, "numbers", "end"))
+                    else:
+                        logger.debug("Skip trying `numbers` as the callable parameter as some lines were not numbers.")
+                    if need_lines:
+                        # ex: echo -e "1\n2\n3\n4" | pz  --end "' - '.join" ->  1 - 2 - 3 - 4
+                        attempts.append((lines, "lines", "end"))
+                if not any(try_argument(line, *x, rewrite=rewrite) for x in attempts):
+                    raise
+            else:
+                if (rewrite and not final_round and not tried_to_correct_callable and line is s
+                        and "main" in compiled and compiled["main"][1] == "s"):
+                    # ex: `| pz s.lower` -> `| pz s.lower()`, the next lines are not callables to be resolved
+                    tried_to_correct_callable = True
+                    command["main"] += "()"
+                    logger.debug(f"Changing the main clause to: {command['main']}")
+                    compile_command("main")
+                    determine_needs()
+                output(result)
+        else:  # ex: int, str
+            write(line)
+    else:
+        if args.empty or (line == 0 and line is not False):
+            write(line)
+
+
+def learn_writer(line):
+    """ Output the line generically. Choose the writer of the next lines by its type. """
+    global write_line
+    if line is not None and not callable(line):  # ex: a filtered line does not tell the type, a callable gets resolved
+        write_line = choose_writer(line)
+    output(line)
+
+
+def choose_writer(sample):
+    """ Return the function that outputs the lines of the same type as the sample faster than the generic `output`
+        (the type dispatch is done once). A line of another type falls back to `output`. """
+    kind = type(sample)
+    raw = write_pipe.buffer  # BulkWriter
+    pending, line_flush, size = raw.pending, raw.line_flush, raw.size
+    encoding, errors = write_pipe.encoding, write_pipe.errors
+    empty = args.empty
+
+    if kind is str:
+        def writer(line):
+            nonlocal pending
+            if type(line) is str and line:
+                pending += line.encode(encoding, errors) + b"\n"
+            elif line is None and not empty:
+                return
+            else:
+                return output(line)
+            if line_flush or len(pending) >= size or raw.error:
+                raw.flush()
+    elif kind is bytes:
+        def writer(line):
+            nonlocal pending
+            if type(line) is bytes and line:
+                pending += line + b"\n"
+            elif line is None and not empty:
+                return
+            else:
+                return output(line)
+            if line_flush or len(pending) >= size or raw.error:
+                raw.flush()
+    elif kind in (tuple, dict):
+        def writer(line):
+            nonlocal pending
+            if type(line) is kind and line:
+                pending += format_record(line).encode(encoding, errors) + b"\n"
+            elif line is None and not empty:
+                return
+            else:
+                return output(line)
+            if line_flush or len(pending) >= size or raw.error:
+                raw.flush()
+    elif kind in (int, float):
+        def writer(line):
+            nonlocal pending
+            if type(line) is kind:
+                pending += str(line).encode() + b"\n"
+            elif line is None and not empty:
+                return
+            else:
+                return output(line)
+            if line_flush or len(pending) >= size or raw.error:
+                raw.flush()
+    elif kind is match_class:
+        def writer(line):
+            nonlocal pending
+            if type(line) is match_class:
+                groups = line.groups()
+                if groups:
+                    pending += format_record(groups).encode(encoding, errors) + b"\n"
+                elif line.group(0):
+                    pending += line.group(0).encode(encoding, errors) + b"\n"
+                else:
+                    return output(line)
+            elif line is None and not empty:
+                return
+            else:
+                return output(line)
+            if line_flush or len(pending) >= size or raw.error:
+                raw.flush()
+    else:
+        writer = output
+    return writer
+
+
+def collect_line(line):
+    """ Instead of writing the output line, pass it to the `--group-by` or `--sort` collector.
+        The key expressions see the line in `s`. """
+    global s
+    if isinstance(line, match_class):
+        line = line.groups() or line.group(0)
+    if isinstance(line, list):  # list is output as multiple lines
+        for el in line:
+            collect_line(el)
+        return
+    if not line and not args.empty and not (line == 0 and line is not False):  # the line would make no output
+        return
+    if not isinstance(line, (str, bytes, tuple, dict)) and isinstance(line, Iterable):  # ex: a generator
+        line = tuple(line)
+    s = line
+    namespace = globals()
+    if groups is not None:
+        groups.add(eval(group_code, namespace), [code and eval(code, namespace) for code in agg_codes])
+    else:
+        sorter.add(eval(sort_code, namespace) if sort_code else line, line)
+
+
+def output_collected():
+    """ Output the `--group-by` rows and the `--sort` lines, merged from the spilled runs. """
+    global s, write_line
+    namespace = globals()
+    rows = groups
+    if sorter is not None:
+        if groups is not None:  # sort the rows of the groups
+            for s in groups:
+                sorter.add(eval(sort_code, namespace) if sort_code else s, s)
+        rows = sorter
+    write_line = learn_writer
+    try:
+        for line in rows:
+            write_line(line)
+    except BrokenPipeError:
+        logger.debug("BrokenPipeError: No output pipe when writing the sorted or grouped lines")
+    except KeyboardInterrupt:
+        pass
+    except Exception as exc:  # ex: the keys of the same type that cannot be compared, like dicts
+        logger.warning(f"Exception: {type(exc)} {exc} when sorting or grouping the lines")
+
+
+def get_number(v):
+    num = None
+    try:
+        # we prefer having int over float because adding values '5' + '5' as '10'
+        # looks better than '10.0' in most use cases
+        num = float(v)
+        num = int(v)  # "10.0" -> int conversion fails and num stays float
+    except (ValueError, TypeError):
+        pass
+    return num
+
+
+def prepare_command(name):
+    original = cmd = (getattr(args, name) or "").strip()  # read from args.main, args.end
+
+    if args.format:
+        cmd = "f'''" + cmd + "'''"
+
+    if name == "main" and regular_command:
+        # prepending `line = ` is not needed, the string is treated as a `match` parameter
+        pass
+    else:
+        cmd = complete_clause(cmd, args.filter)
+
+    if name == "main":
+        if not cmd and (args.generate is not None or args.sort or args.group_by or args.chain):
+            cmd = "# generator"  # force args.run to be True by having a command, the lines are output
+        if args.stderr:
+            if not cmd:
+                # it is not intended to pipe everything to STDERR while everything is piped unchanged to STDOUT too
+                cmd = 's = None'
+            if not args.zero:  # when using the --stderr flag, we pass the original content to the STDOUT
+                cmd += '\nsys.stdout.write(original_line+"\\n")'
+
+    if original != cmd:  # verbose output
+        logger.debug(f"Changing the {name} clause to: {cmd.strip()}")
+    command[name] = cmd
+    if name != "main" or not regular_command:
+        compile_command(name)
+
+
+def complete_clause(cmd, filter_=False):
+    """ Prepend `s = ` (or `skip = not ` when filtering) to a single expression so that its value gets output. """
+    if (len(cmd.splitlines()) == 1  # check if there is only a single line with a missing assignment
+            # filter out, if any of 3 string assignment operators is already there
+            and not assignment.search(cmd)  # ex: `s = s = 1` would be redundant (but do fill `s = s == 1`)
+            and not augmented_assignment.search(cmd)  # ex: `s = s += 1` and `s = s *= 1` would fail
+            # do not assign to reserved keywords (ex: `s = if s == 1: ...` would fail)
+            and not any(cmd.lstrip().startswith(keyword) for keyword in ("if", "while", "for"))
+            and ";" not in cmd
+            and "lines." not in cmd):
+        # "s = 1" - will not pass
+        # "s += 1" - will not pass
+        # "s + 1" - will pass
+        # "s == 1" - will pass
+        # "if s == 1: print(s)" - will not pass
+        cmd = ("skip = not " if filter_ else "s = ") + cmd
+    return cmd
+
+
+def compile_clause(cmd):
+    """ Compile a clause to a code object. If it cannot be compiled, return the source back,
+        so that the SyntaxError gets raised (and reported) when executed as before. """
+    try:
+        return builtins.compile(cmd, "<string>", "exec")  # note that `compile` may stand for `re.compile`
+    except SyntaxError:
+        return cmd
+
+
+def compile_command(name):
+    """ Compile the clause just once instead of letting `exec` parse it on every line. """
+    compiled[name] = compile_expression(command[name])
+
+
+def compile_expression(cmd):
+    """ A single expression assigned to `s` or `skip` takes the `eval` fast path: return the code object
+        and the name of the variable to be assigned (or None when executed as a whole). """
+    m = expression_assignment.fullmatch(cmd)
+    if m:
+        try:
+            return builtins.compile(m[2].strip(), "<string>", "eval"), m[1]
+        except SyntaxError:  # ex: `s = a = 1` or multiple statements
+            pass
+    return compile_clause(cmd), None
+
+
+def bare_callable(cmd, target):
+    """ Whether the clause is a single callable expression (ex: `pz sum`, `pz --end "' - '.join"`) that might get
+        `s`, `n`, `lines` or `numbers` as the parameter. Not the aggregator methods (ex: `pz --end P.quantile`),
+        they work with the numbers already fed. """
+    expression = cmd.partition("=")[2].strip() if target else ""
+    return bool(callable_expression.search(expression) and expression not in scope_variables
+                and expression.partition(".")[0] not in aggregators)
+
+
+def code_names(code):
+    """ Return the names the code object (and the nested ones, ex: a lambda) refers to.
+        Return None if unknown (ex: `eval` used). A clause that could not be compiled refers to nothing. """
+    if isinstance(code, str):
+        return set()
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, type(code)):
+            nested = code_names(const)
+            if nested is None:
+                return None
+            names |= nested
+    return None if names & {"eval", "exec", "globals", "vars", "locals"} else names
+
+
+def determine_needs():
+    """ Inspect the names the clauses refer to in order to compute or keep only the variables that are used.
+        Ex: `pz 's.upper()'` neither parses the numbers nor grows the `lines` (which is important for an infinite input).
+    """
+    global clause_names, need_b, need_n, need_r, need_s, need_lines, need_numbers, feed_numbers, feed_lines, \
+        need_file_count
+    # the end clause sees the lines the last --chain clause got, not the input lines
+    main_clauses = [name for name in compiled if name == "main" or not stages]
+    codes = [compiled[name][0] for name in main_clauses]
+    if args.insecure and os.environ.get("PZ_SETUP"):
+        codes.append(compile_clause(os.environ["PZ_SETUP"]))
+    if args.setup:
+        codes.append(compile_clause(args.setup))
+    codes.extend(code for code in (sort_code, group_code, *agg_codes) if code)
+    names = set()
+    streamed = set()  # names the clauses run while processing the input refer to (not the end clause)
+    for code in codes:
+        nested = code_names(code)
+        if nested is None:
+            names = streamed = None
+            break
+        names |= nested
+        if not ("end" in main_clauses and code is compiled["end"][0]):
+            streamed |= nested
+
+    imported = codes + [stage.code for stage in stages]
+    if stages:
+        imported.append(compiled["end"][0])
+    import_names(imported, names is None)
+    if names is None:  # we cannot tell, everything might be needed
+        clause_names = {"b", "n", "r", "s", "lines", "numbers", "text", "count", *aggregators}
+    else:
+        clause_names = names
+        for name in main_clauses:
+            if bare_callable(command[name], compiled[name][1]):
+                clause_names |= {"n", "s", "lines", "numbers"}
+                if name == "main":
+                    streamed |= {"lines", "numbers"}
+    feed_numbers, feed_lines = fed_aggregators(codes, clause_names, globals())
+    need_b = "b" in clause_names
+    need_r = bool(parse_records) and "r" in clause_names
+    need_lines = args.lines and bool({"lines", "text"} & clause_names)
+    need_numbers = args.lines and "numbers" in clause_names
+    need_n = need_numbers or bool(feed_numbers) or "n" in clause_names
+    need_file_count = "file_count" in clause_names
+    # a generated number is formatted to `s` only if it is not just output (that would format it the same)
+    need_s = (need_b or need_r or need_lines or bool(feed_lines) or bool({"s", "original_line"} & clause_names)
+              or bool(regular_command) or args.stderr
+              # the collected lines are sorted as the text, whether generated or read (ex: `pz -g 12 --sort`)
+              or args.sort is not None or args.group_by is not None)
+    # a clause gets a list, the compact storage is converted for the end clause only
+    for name, needed, compact in (("lines", need_lines, Lines), ("numbers", need_numbers, Numbers)):
+        if needed:
+            value = globals().setdefault(name, compact())
+            if (streamed is None or name in streamed) and isinstance(value, compact):
+                globals()[name] = value.to_list()
+    for stage in stages:  # ex: whether the `text` is used
+        clause_names = clause_names | stage.names
+
+
+def fed_aggregators(codes, names, scope):
+    """ Return the names of the streaming aggregators to be fed with every number and the ones with every line,
+        create them in the scope. A name the clauses assign to (ex: `pz -0 'H = n' --end H`) is not fed,
+        neither is an object that is not an aggregator. """
+    assigned = set()
+    for code in codes:
+        if code and not isinstance(code, str):
+            assigned |= global_names(code, set(aggregators))[1]
+    fed = [name for name in aggregators if name in names and name not in assigned
+           and isinstance(scope.setdefault(name, aggregators[name][0]()), Aggregator)]
+    return [name for name in fed if aggregators[name][1] == "n"], [name for name in fed if aggregators[name][1] == "s"]
+
+
+def run_setup():
+    """ Run the code from the `PZ_SETUP` environment variable and the setup clause. """
+    if args.insecure and os.environ.get("PZ_SETUP"):
+        exec(compile_clause(os.environ["PZ_SETUP"]), globals())
+
+    if args.setup:
+        setup_code = compile_clause(args.setup)
+        while True:
+            with auto_import():
+                exec(setup_code, globals())
+                break
+
+
+def process(loop, generated=False):
+    """ Run the main clause on every line. Note that the clauses are executed in the global scope.
+        If generated, the loop yields the numbers that are fed straight to `n`, without the bytes round trip. """
+    global b, s, n, r, count, file_count, skip, original_line
+    namespace = globals()
+    while True:
+        try:
+            try:
+                if generated:
+                    n = next(loop)
+                    s = str(n) if need_s else n
+                    if need_b:
+                        b = s.encode()
+                    if need_r:
+                        r = parse_records([s])[0]
+                elif need_r:
+                    b, s, r = next(loop)
+                else:
+                    b, s = next(loop)
+            except StopIteration:
+                break
+            original_line = s
+            if need_n:
+                if not generated:
+                    n = get_number(s)
+                if need_numbers and n is not None:
+                    numbers.append(n)
+                if feed_numbers and n is not None:
+                    for name in feed_numbers:
+                        namespace[name].add(n)
+            for name in feed_lines:
+                namespace[name].add(s)
+            count += 1
+            if need_file_count:
+                file_count += 1
+            if need_lines:
+                lines.append(s)
+
+            if args.run is not True:  # speed up, further processing not needed
+                continue
+
+            while True:  # loop until all on the fly imports are done
+                try:  # cheaper than entering the `auto_import` context manager on every line
+                    skip = None
+                    # we process either a regular expression or a custom command
+                    if regular_command:
+                        try:
+                            s = regular_command(s)
+                        except re.error as exc:
+                            logger.error(f"{exc}, regular expression: {args.main} on line: {s}")
+                            break
+                    else:  # resolving custom command
+                        cached = memo.get(original_line) if memo else None
+                        if cached:
+                            s, skip = cached
+                            if args.stderr and not args.zero:  # the clause passes the line to the STDOUT too
+                                sys.stdout.write(original_line + "\n")
+                        else:
+                            code, target = compiled["main"]
+                            if target == "s":
+                                s = eval(code, namespace)
+                            elif target == "skip":
+                                skip = eval(code, namespace)
+                            else:
+                                exec(code, namespace)
+                            if memo:
+                                memo.put(original_line, (s, skip))
+                    if skip or (skip_all and skip is not False):  # user chooses to filter out the line
+                        if meter:
+                            meter.skipped += 1
+                        break
+                    write_line(s)
+                    break
+                except NameError as e:
+                    resolve_name_error(e)
+        except BrokenPipeError:
+            # do not continue processing when pipe is broken
+            # ex: process we pipe into is killed
+            # There is a chance we want to pipe something to the STDERR in the --end clause, hence we do not quit.
+            s = args.main if regular_command else command['main']
+            logger.debug(f"BrokenPipeError: No output pipe when processing the main clause '{s}'")
+            break
+        except KeyboardInterrupt:  # useful for ending up an infinite generator
+            # Break but continue when SIGINT caught in case we have an END clause.
+            # No problem when output to the terminal or to the STDERR. If output to another process via STDOUT,
+            # since whole process group received SIGINT, the output is lost if the process is stopping right now,
+            # or BrokenPipeError is raised if the process has already stopped.
+            break
+        except Exception as exc:
+            if meter:
+                meter.exceptions += 1
+            logger.warning(f'Exception: {type(exc)} {exc} on line: {s}')
+            continue
+
+
+def call_clause(function, number, line, cmd):
+    """ Call the result of the callable clause with no argument, the number or the line (see `output` for more
+        attempts made with the output of the main clause). Return the result and the variable passed. """
+    attempts = [((), "")]
+    if number is not None:
+        attempts.append(((number,), "n"))
+    attempts.append(((line,), "s"))
+    for arguments, var in attempts:
+        try:
+            return function(*arguments), var
+        except TypeError as e:
+            logger.debug(f"Failed attempt to use `{var or '()'}` as the callable parameter of: {cmd} with: {e}")
+    raise TypeError(f"Cannot find the parameter of the callable: {cmd}")
+
+
+class Stage:
+    """ A `--chain` clause run on every line the previous clause outputs. The value is passed as an object, not
+        written and parsed again: `s` holds its text, `n` the number and `r` the tuple or dict, as they were.
+        The stage has its own `count`, `lines`, `numbers` and the streaming aggregators; they are swapped
+        into the global scope while its clause runs (and handed over to the end clause if it is the last one). """
+
+    def __init__(self, clause, first=False, last=False):
+        cmd = clause.strip()
+        if args.format:
+            cmd = "f'''" + cmd + "'''"
+        self.command = complete_clause(cmd)
+        self.code, self.target = compile_expression(self.command)
+        self.bare = bare_callable(self.command, self.target)  # resolved with the first line, see `call`
+        self.main_callable = (first and not regular_command  # ex: `pz sqrt -c round`
+                              and bare_callable(command["main"], compiled["main"][1]))
+        self.write = self.learn
+        self.skip_all = False
+
+        names = set()
+        for code in (self.code, compiled["end"][0] if last else None):
+            nested = code_names(code) if code else set()
+            if nested is None:
+                names = {"b", "n", "r", "s", "lines", "numbers", "text", "count", *aggregators}
+                break
+            names |= nested
+        if self.bare:
+            names |= {"n", "s"}
+        if last and bare_callable(command["end"], compiled["end"][1]):
+            names |= {"lines", "numbers"}
+        self.names = names
+        self.need_b = "b" in names
+        self.need_r = "r" in names
+        self.need_lines = args.lines and bool({"lines", "text"} & names)
+        self.need_numbers = args.lines and "numbers" in names
+        self.state = {"count": 0}  # the variables of the stage
+        self.feed_numbers, self.feed_lines = fed_aggregators((self.code, compiled["end"][0] if last else None),
+                                                             names, self.state)
+        self.need_n = self.need_numbers or bool(self.feed_numbers) or "n" in names
+        # an exec-ed clause not assigning `s` outputs the line unchanged
+        self.need_s = (self.need_b or self.need_lines or bool(self.feed_lines) or not self.target
+                       or bool({"s", "original_line"} & names))
+        # only the variables the clause refers to get swapped (the ones the end clause refers to are handed over)
+        own = code_names(self.code)
+        if self.need_lines:
+            self.state["lines"] = [] if own is None or "lines" in own else Lines()
+        if self.need_numbers:
+            self.state["numbers"] = [] if own is None or "numbers" in own else Numbers()
+        self.collecting = len(self.state) > 1
+        self.swapped = [name for name in self.state if own is None or name in own]
+
+    def feed(self, value):
+        """ Process a line the previous clause outputs. """
+        global b, s, n, r
+        kind = type(value)
+        if kind is str:
+            if not value and not args.empty:
+                return
+            b = n = r = None
+            s = value
+            if self.need_n:
+                n = get_number(value)
+            if self.need_r and parse_records:
+                r = parse_records([value])[0]
+        elif kind is int or kind is float:
+            b = r = None
+            n = value
+            s = str(value) if self.need_s else value
+        elif kind is tuple and value:
+            b = n = None
+            r = value
+            s = format_record(value) if self.need_s else value
+        else:
+            return self.feed_other(value)
+        if self.need_b:
+            b = s.encode()
+        self.run()
+
+    def feed_other(self, value):
+        """ Process a line of another type than str, number or tuple. As with the output, a list stands
+            for multiple lines. """
+        global b, s, n, r
+        if self.main_callable and callable(value):  # resolved here as the main clause is not output
+            value, var = call_clause(value, n, original_line, command["main"])
+            self.main_callable = False
+            command["main"] += f"({var})"
+            logger.debug(f"Changing the main clause to: {command['main']}")
+            compile_command("main")
+            determine_needs()
+        elif isinstance(value, match_class):
+            value = value.groups() or value.group(0)
+        elif getattr(value, "ndim", None) is not None:  # NumPy array or scalar
+            value = [tuple(row) for row in value.tolist()] if value.ndim > 1 else value.tolist()
+        elif isinstance(value, Aggregator):
+            value = value.result()
+        if isinstance(value, list):
+            for item in value:
+                self.feed(item)
+            return
+        if type(value) in (str, int, float, tuple):
+            return self.feed(value)
+        if not value and not args.empty and not (value == 0 and value is not False):
+            return  # the line would not be output
+
+        b = n = r = None
+        if isinstance(value, bytes):
+            b, s = decode_line(value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            n = value
+            s = str(value)
+        elif isinstance(value, Iterable):  # ex: a dict or a generator
+            r = value if isinstance(value, (tuple, dict)) else tuple(value)
+            s = format_record(r) if self.need_s else r
+        else:
+            s = str(value)
+        if self.need_n and n is None and r is None:  # ex: `pz b -c 'n + 1'` or `pz 'Path(s)' -c n`
+            n = get_number(s)
+        if self.need_b and b is None:
+            b = s.encode()
+        self.run()
+
+    def run(self):
+        """ Run the clause on the line in `s` (`n`, `b`, `r` are set). """
+        global s, skip, original_line
+        original_line = s
+        state = self.state
+        state["count"] += 1
+        if self.collecting:
+            if self.need_lines:
+                state["lines"].append(s)
+            if n is not None:
+                if self.need_numbers:
+                    state["numbers"].append(n)
+                for name in self.feed_numbers:
+                    state[name].add(n)
+            for name in self.feed_lines:
+                state[name].add(s)
+        if not self.command:  # as with the main clause, no clause means no output, the lines are just counted
+            return
+
+        namespace = globals()
+        if self.swapped:
+            outer = [namespace.get(name) for name in self.swapped]
+            namespace.update((name, state[name]) for name in self.swapped)
+        try:
+            while True:  # loop until all on the fly imports are done
+                try:
+                    skip = None
+                    code, target = self.code, self.target
+                    if target == "s":
+                        s = eval(code, namespace)
+                    elif target == "skip":
+                        skip = eval(code, namespace)
+                    else:
+                        exec(code, namespace)
+                    if self.bare and callable(s):
+                        s = self.call(s, n)
+                    break
+                except NameError as e:
+                    resolve_name_error(e)
+        except Exception as exc:
+            if meter:
+                meter.exceptions += 1
+            logger.warning(f'Exception: {type(exc)} {exc} on line: {original_line}')
+            return
+        finally:
+            if self.swapped:
+                namespace.update(zip(self.swapped, outer))
+        if skip or (self.skip_all and skip is not False):  # user chooses to filter out the line
+            if meter:
+                meter.skipped += 1
+            return
+        self.write(s)
+
+    def call(self, function, number):
+        """ Resolve the callable clause (ex: `round`, `s.lower`), the next lines are called the same way. """
+        result, var = call_clause(function, number, original_line, self.command)
+        self.command += f"({var})"
+        self.code, self.target = compile_expression(self.command)
+        self.bare = False
+        logger.debug(f"Changing the --chain clause to: {self.command}")
+        return result
+
+    def learn(self, line):
+        """ Output the line of the last stage generically, then choose the writer by its type, see `learn_writer`. """
+        if line is not None and not callable(line):
+            self.write = choose_writer(line)
+        output(line)
+
+    def hand_over(self):
+        """ Let the end clause see the variables of the last stage. """
+        if meter:
+            meter.lines_in = count
+        globals().update(self.state, need_lines=self.need_lines, need_numbers=self.need_numbers)
+
+
+def bulk_regex():
+    """ Return the regular expression flag pattern compiled as bytes to scan the whole blocks with
+        or None if the lines must be processed one by one (the per-line semantics could not be kept). """
+    if (args.generate is not None or args.n is not None or args.empty or skip_all or args.split or args.csv
+            or args.jsonl or args.sort or args.group_by or stages or need_b or need_n or need_lines or feed_lines
+            or not hasattr(bytes, "isascii")):
+        return None
+    pattern = args.main
+    if not pattern.isascii() or re.search(r"\\[ABZ]|\(\?<?[=!]", pattern):
+        return None  # str-only meaning or the lookarounds and anchors would see over the line end
+    parser = getattr(re, "_parser", None) or re.sre_parse
+    try:
+        if not parser.parse(pattern).getwidth()[0]:
+            return None  # an empty match would be found at the positions between the lines too
+    except re.error:
+        return None
+    if args.sub and re.search(r"\n|\\[nx0]|\\[0-7]{3}", args.sub):
+        return None  # the substitution might produce a newline
+    if args.match:
+        pattern = f"^(?:{pattern})"
+    try:
+        return re.compile(pattern.encode(), re.MULTILINE)
+    except re.error:  # ex: `\u` escape or an inline flag no more at the start
+        return None
+
+
+def process_regex(blocks, pattern):
+    """ Run the regular expression flag on whole ASCII blocks at once with the bytes pattern, the results go
+        straight to the output buffer. Yield (bytes, str) line pairs of the blocks to be processed line by line:
+        non-ASCII, with `\\x1c`–`\\x1f` that str `\\s` matches or a match spanning over the newline. """
+    global count
+    raw = write_pipe.buffer  # BulkWriter
+    groups = pattern.groups
+    separators = (b"\x1c", b"\x1d", b"\x1e", b"\x1f") if re.search(r"\\[sS]", args.main) else ()
+    if args.sub:
+        template = args.sub.encode(write_pipe.encoding, write_pipe.errors)
+    missing = b"" if args.findall else b"None"  # `findall` gives empty str for a non-participating group
+    first_only = not args.findall
+
+    def scan(block, last):
+        """ Return the output of the block or None if a match spans over the newline. """
+        if args.findall and not groups:  # the most common case all in C
+            out = [*filter(None, pattern.findall(block, 0, last))]
+            if b"\n".join(out).count(b"\n") >= len(out):
+                return None
+        elif args.sub:
+            body = block[:last]
+            if any(b"\n" in m.group() for m in pattern.finditer(body)):
+                return None
+            out = [*filter(None, pattern.sub(template, body).split(b"\n"))]
+        else:
+            out = []
+            line_end = -1
+            for m in pattern.finditer(block, 0, last):
+                start, end = m.span()
+                new_line = start > line_end
+                if new_line:
+                    line_end = block.find(b"\n", start)
+                if end > line_end:
+                    return None
+                if not new_line and first_only:  # `search` and `match` take the first match on the line only
+                    continue
+                if groups > 1 or groups and first_only:  # a tuple or `Match.groups()` is output even if empty
+                    out.append(b"\t".join(m.groups(missing)))
+                elif m.group(groups):
+                    out.append(m.group(groups))
+        return b"\n".join(out) + b"\n" if out else b""
+
+    for block in blocks:
+        if whitespace_ending.search(block):
+            block = trailing_whitespace.sub(b"\n", block)
+        result = None
+        if block.isascii() and not any(c in block for c in separators):
+            result = scan(block, len(block) - 1)  # the position after the last newline is not a line start
+        if result is None:
+            yield from split_block(block)
+            continue
+        count += block.count(b"\n")
+        if result:
+            raw.write(result)
+
+
+def execute(name):
+    """ Run the compiled clause in the global scope. """
+    code, target = compiled[name]
+    if target:
+        globals()[target] = eval(code, globals())
+    else:
+        exec(code, globals())
+
+
+def to_array(values):
+    """ Convert the strings to a NumPy array of floats, NaN where not a number. """
+    try:
+        return numpy.array(values, dtype=float)
+    except ValueError:
+        return numpy.fromiter((x if x is not None else math.nan for x in map(get_number, values)), float, len(values))
+
+
+def process_concurrent(loop):
+    """ Run the main clause for up to `--concurrency` lines at once in the threads.
+        Every line gets its own copy of the global scope: the variables the clause sets are local to the line,
+        the objects like `S`, `L`, `D`, `C` are shared. The lines are output in the input order unless `--unordered`.
+        At most twice as many lines as the threads are read ahead so that the memory stays bounded. """
+    global b, s, n, count
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    namespace = globals()
+    pending = set() if args.unordered else deque()
+    executor = ThreadPoolExecutor(args.concurrency)
+
+    def write_result(future):
+        s_, skip_ = future.result()
+        if skip_ or (skip_all and skip_ is not False):
+            if meter:
+                meter.skipped += 1
+            return
+        write_line(s_)
+
+    def write_finished():
+        if args.unordered:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.remove(future)
+                write_result(future)
+        else:
+            write_result(pending.popleft())
+
+    try:
+        for b, s, *record in loop:  # the record `r` is there if needed
+            if need_n:
+                n = get_number(s)
+                if need_numbers and n is not None:
+                    numbers.append(n)
+                if feed_numbers and n is not None:
+                    for name in feed_numbers:
+                        namespace[name].add(n)
+            for name in feed_lines:
+                namespace[name].add(s)
+            count += 1
+            if need_lines:
+                lines.append(s)
+
+            if args.run is not True:
+                continue
+            if len(pending) >= args.concurrency * 2:
+                write_finished()
+            scope = {**namespace, "original_line": s, "skip": None}
+            if record:
+                scope["r"] = record[0]
+            future = executor.submit(run_line, scope)
+            if args.unordered:
+                pending.add(future)
+            else:
+                pending.append(future)
+        while pending:
+            write_finished()
+    except BrokenPipeError:
+        logger.debug(f"BrokenPipeError: No output pipe when processing the main clause '{command['main']}'")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def run_line(scope):
+    """ Thread: run the main clause in the scope of a line. Await the awaitable result. Return `(s, skip)`. """
+    try:
+        code, target = compiled["main"]
+        while True:
+            with auto_import():
+                if target:
+                    scope[target] = eval(code, scope)
+                else:
+                    exec(code, scope)
+                if inspect.isawaitable(scope["s"]):
+                    scope["s"] = asyncio.run_coroutine_threadsafe(awaited(scope["s"]), event_loop()).result()
+                if callable(scope["s"]):  # ex: `pz --concurrency 2 sqrt`, resolved with the line of this thread
+                    number = scope["n"] if need_n else get_number(scope["original_line"])
+                    scope["s"] = call_clause(scope["s"], number, scope["original_line"], command["main"])[0]
+                break
+            scope.update((name, value) for name, value in globals().items() if name not in scope)  # just imported
+        return scope["s"], scope["skip"]
+    except Exception as exc:
+        if meter:
+            meter.exceptions += 1
+        logger.warning(f'Exception: {type(exc)} {exc} on line: {scope["original_line"]}')
+        return None, True
+
+
+async def awaited(awaitable):
+    """ Wrap the awaitable to a coroutine. """
+    return await awaitable
+
+
+def event_loop():
+    """ Return the asyncio loop running in its own thread, start it if needed. """
+    global running_loop
+    with loop_lock:
+        if not running_loop:
+            from threading import Thread
+            running_loop = asyncio.new_event_loop()
+            Thread(target=running_loop.run_forever, daemon=True).start()
+    return running_loop
+
+
+def pooled_get():
+    """ Return the `get` of a `requests.Session` that keeps a connection per thread of the `--concurrency` mode alive. """
+    import requests
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=args.concurrency, pool_maxsize=args.concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session.get
+
+
+def process_batches(loop):
+    """ Run the main clause once per a chunk of lines.
+        `S` holds the lines, `N` the array of numbers and `COLS` the arrays of the `--split` columns. """
+    global S, N, COLS, s, skip, count
+    while True:
+        try:
+            S = [line[1] for line in islice(loop, args.batch)]
+            if not S:
+                break
+            count += len(S)
+            if need_lines:
+                lines.extend(S)
+            if need_numbers or feed_numbers:
+                numbers_ = [x for x in map(get_number, S) if x is not None]
+                if need_numbers:
+                    numbers.extend(numbers_)
+                for name in feed_numbers:
+                    globals()[name].update(numbers_)
+            for name in feed_lines:
+                globals()[name].update(S)
+            if "N" in clause_names:
+                N = to_array(S)
+            if "COLS" in clause_names:
+                rows = parse_records(S) if parse_records else (x.split() for x in S)
+                COLS = [to_array(column) for column in zip_longest(*rows, fillvalue="")]
+
+            while True:
+                with auto_import():
+                    s, skip = S, None
+                    execute("main")
+                    if skip or (skip_all and skip is not False):
+                        break
+                    output(s)
+                    break
+        except BrokenPipeError:
+            logger.debug(f"BrokenPipeError: No output pipe when processing the main clause '{command['main']}'")
+            break
+        except KeyboardInterrupt:
+            break
+        except Exception as exc:
+            if meter:
+                meter.exceptions += 1
+            logger.warning(f'Exception: {type(exc)} {exc} on the batch ending with the line: {count}')
+
+
+def start_pool():
+    """ Fork the worker processes for the `--jobs` mode. """
+    from multiprocessing import get_context
+    return get_context("fork").Pool(args.jobs, init_worker)
+
+
+def init_worker():
+    """ Capture the worker output so that the main process writes it in the right order. Run the setup clause.
+        Its output is dropped, the main process runs the setup clause too and prints it once. """
+    global captured
+    captured = io.BytesIO(), io.BytesIO()
+    redirect_output(*captured)
+    from contextlib import redirect_stderr, redirect_stdout
+    with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+        run_setup()
+
+
+def process_chunk(task):
+    """ Worker: process a chunk of lines. Return its output and the global variables to be merged. """
+    global count, i, S, L, D, C
+    count, chunk = task
+    i, S, L, D, C = 0, set(), list(), dict(), Counter()
+    for name in feed_numbers + feed_lines:
+        globals()[name] = type(globals()[name])()
+    process(iter(chunk))
+    output_ = []
+    for pipe, buffer in zip((sys.stdout, sys.stderr), captured):
+        pipe.flush()
+        output_.append(buffer.getvalue())
+        buffer.seek(0)
+        buffer.truncate()
+    return output_, (i, S, L, D, C, {name: globals()[name] for name in feed_numbers + feed_lines})
+
+
+def process_parallel(pool, loop):
+    """ Split the input into chunks of lines and process them in the worker processes.
+        Chunks are written out in the input order unless `--unordered`.
+        Global variables `i`, `S`, `L`, `D`, `C` and the aggregators of every chunk are merged
+        into the ones of the main process. """
+    from queue import Queue
+    pending = deque()  # results in the input order
+    finished = Queue()  # results in the order of completion
+
+    def write_result():
+        global i
+        result = finished.get() if args.unordered else pending.popleft().get()
+        if isinstance(result, Exception):
+            raise result
+        output_, (i_, S_, L_, D_, C_, aggregators_) = result
+        for pipe, data in zip((sys.stdout, sys.stderr), output_):
+            if data:
+                pipe.buffer.write(data)
+        i += i_
+        S.update(S_)
+        L.extend(L_)
+        D.update(D_)
+        C.update(C_)
+        for name, aggregator in aggregators_.items():
+            globals()[name].merge(aggregator)
+
+    global count
+    in_flight = 0
+    try:
+        while True:
+            chunk = list(islice(loop, JOB_CHUNK))
+            if not chunk:
+                break
+            if in_flight >= args.jobs * 2:  # keep the memory bounded when the input is infinite
+                write_result()
+                in_flight -= 1
+            if args.unordered:
+                pool.apply_async(process_chunk, ((count, chunk),),
+                                 callback=finished.put, error_callback=finished.put)
+            else:
+                pending.append(pool.apply_async(process_chunk, ((count, chunk),)))
+            in_flight += 1
+            count += len(chunk)
+        while in_flight:
+            write_result()
+            in_flight -= 1
+    except BrokenPipeError:
+        logger.debug(f"BrokenPipeError: No output pipe when processing the main clause '{command['main']}'")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.terminate()
+
+
+def server_path():
+    """ Path of the Unix socket of the `--serve` mode. Without `$XDG_RUNTIME_DIR`, the socket is put in a private
+        directory in `/tmp` as another user could take a predictable path there first. Keep in sync with
+        `extra/pz-client`. """
+    if os.environ.get("PZ_SERVER"):
+        return os.environ["PZ_SERVER"]
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return os.path.join(os.environ["XDG_RUNTIME_DIR"], f"pz-{os.getuid()}.sock")
+    return os.path.join("/tmp", f"pz-{os.getuid()}", "pz.sock")
+
+
+def owned(path, mode=0):
+    """ Whether the path (not followed if a symlink) is owned by the user and no one else has the `mode` permissions. """
+    info = os.lstat(path)
+    return info.st_uid == os.getuid() and not info.st_mode & mode
+
+
+def serve(path):
+    """ Listen on the Unix socket and serve every request in a forked process. The modules are imported just once. """
+    import signal
+    import socket
+    for module in ("argparse", "multiprocessing", *sorted(available_modules)):  # keep the modules warm
+        try:
+            __import__(module)
+        except ImportError:
+            pass
+    with open(__file__) as f:
+        code = builtins.compile(f.read(), __file__, "exec")
+    import gc
+    if hasattr(gc, "freeze"):  # the forked processes do not copy the pages just because the garbage collector touches them
+        gc.freeze()
+
+    directory = os.path.dirname(path) or "."
+    if directory == os.path.join("/tmp", f"pz-{os.getuid()}"):  # the default without `$XDG_RUNTIME_DIR`
+        try:
+            os.mkdir(directory, 0o700)
+        except FileExistsError:
+            pass
+        if not stat.S_ISDIR(os.lstat(directory).st_mode) or not owned(directory, 0o077):
+            logger.error(f"The directory {directory} is not a private directory of yours.")
+            quit()
+    if os.path.lexists(path):
+        if not stat.S_ISSOCK(os.lstat(path).st_mode) or not owned(path):
+            logger.error(f"The path {path} exists and is not a socket of yours.")
+            quit()
+        os.unlink(path)  # a socket left by a server that has not ended properly
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)  # only the user may connect (the requests run arbitrary code)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+    server.listen(64)
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)  # do not leave zombies
+    logger.warning(f"Listening on {path}")
+    try:
+        while True:
+            connection, _ = server.accept()
+            if hasattr(socket, "SO_PEERCRED"):
+                uid = array("i", connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, 12))[1]
+                if uid != os.getuid():
+                    connection.close()
+                    continue
+            if not os.fork():
+                server.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                serve_request(connection, code)
+            connection.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if owned(path):
+            os.unlink(path)
+
+
+def serve_request(connection, code):
+    """ Forked server process: take over the client's STDIN, STDOUT, STDERR, working directory, environment
+        and arguments, then run `pz` from scratch in a fresh namespace. Send back the pid and the exit status. """
+    import socket
+    status = 1
+    try:
+        fds = array("i")
+        data, ancillary, *_ = connection.recvmsg(BLOCK_SIZE, socket.CMSG_LEN(3 * fds.itemsize))
+        for level, type_, fd_data in ancillary:
+            if level == socket.SOL_SOCKET and type_ == socket.SCM_RIGHTS:
+                fds.frombytes(fd_data[:len(fd_data) - len(fd_data) % fds.itemsize])
+        while True:
+            chunk = connection.recv(BLOCK_SIZE)
+            if not chunk:
+                break
+            data += chunk
+        cwd, argc, *fields = data.split(b"\0")
+        argv, environ = fields[:int(argc)], fields[int(argc):]
+
+        for fd, target in zip(fds, (0, 1, 2)):
+            os.dup2(fd, target)
+            os.close(fd)
+        sys.stdin = sys.__stdin__ = open(0, closefd=False)
+        sys.stdout = sys.__stdout__ = open(1, "w", closefd=False)
+        sys.stderr = sys.__stderr__ = open(2, "w", buffering=1, errors="backslashreplace", closefd=False)
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(os.fsdecode(x).split("=", 1) for x in environ)
+        sys.argv = ["pz", *map(os.fsdecode, argv)]
+        connection.sendall(f"{os.getpid()}\n".encode())  # the client forwards SIGINT
+
+        # the `--jobs` workers pickle the functions by the reference to the `__main__` module
+        module = sys.modules["__main__"] = type(sys)("__main__")
+        module.__file__ = __file__
+        exec(code, module.__dict__)
+        status = 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            status = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+    finally:
+        for pipe in (sys.stdout, sys.stderr):
+            try:
+                pipe.flush()
+            except (OSError, ValueError):  # ex: broken pipe or closed by the `pz` run
+                pass
+        try:
+            connection.sendall(f"{status}\n".encode())
+        except OSError:
+            pass
+        os._exit(status)
+
+
+if __name__ == "__main__":
+    if args.serve:
+        serve(server_path() if args.serve is True else args.serve)
+        quit()
+    if args.stats:
+        meter = Meter()
+        meter.install(globals())
+
+    # determine args.run and possibly turn on args.lines
+    args.run = True  # True = run whole processing (output), 1 = partial run (populate `lines`), False = do not run
+    # whether to populate variables like: `lines`, `numbers` (worker processes cannot share them)
+    args.lines = not args.overflow_safe and not args.jobs
+
+    if all(x is None for x in (args.main, args.end, args.generate, args.sort, args.group_by, args.chain)):
+        logger.error("You have to specify either main COMMAND or --end COMMAND.")
+        quit()
+
+    # prepare commands (prepend `line =` if needed)
+    command = {"main": "", "end": ""}
+    compiled = {}  # name → (code object, assigned variable), see `compile_command`
+    regular_command = None  # prepare regular modifications
+    reg_ex = None
+    if args.match or args.findall or args.search or args.sub:
+        try:
+            reg_ex = re.compile(args.main)
+        except re.error as exc:
+            logger.error(f"re.error: Compilation failed with {exc}")
+            quit()
+        if args.match:
+            regular_command = reg_ex.match
+        elif args.search:
+            regular_command = reg_ex.search
+        elif args.findall:
+            regular_command = reg_ex.findall
+        elif args.sub:
+            regular_command = lambda line: reg_ex.sub(args.sub, line)
+        if args.batch:
+            logger.error("The --batch flag cannot be combined with the regular expression flags.")
+            quit()
+        if args.concurrency:
+            logger.error("The --concurrency flag cannot be combined with the regular expression flags.")
+            quit()
+    if args.csv and args.jsonl:
+        logger.error("The --csv and --jsonl flags cannot be combined.")
+        quit()
+    parse_records = record_parser()  # input records `r`
+    format_record = record_formatter()  # output tuples
+    if args.sort or args.group_by:
+        if args.jobs or args.batch or args.concurrency:
+            logger.error("The --sort and --group-by flags cannot be combined with --jobs, --batch or --concurrency.")
+            quit()
+        try:
+            if isinstance(args.sort, str):
+                sort_code = builtins.compile(args.sort, "<sort>", "eval")
+            if args.group_by:
+                group_code = builtins.compile(args.group_by, "<group-by>", "eval")
+                agg_names, agg_codes = zip(*map(parse_aggregation, args.agg or ["count"]))
+        except (SyntaxError, ValueError) as exc:
+            logger.error(f"Cannot parse the --sort, --group-by or --agg expression: {exc}")
+            quit()
+        if args.group_by:
+            groups = ExternalGroups(agg_names, args.mem_limit)
+        if args.sort:
+            sorter = ExternalSort(args.mem_limit)
+    elif args.agg:
+        logger.error("The --agg flag needs --group-by.")
+        quit()
+    if args.chain and (args.jobs or args.batch or args.concurrency):
+        logger.error("The --chain flag cannot be combined with --jobs, --batch or --concurrency.")
+        quit()
+    [prepare_command(name) for name in command]
+    if args.chain:
+        stages = [Stage(clause, k == 0, k == len(args.chain) - 1) for k, clause in enumerate(args.chain)]
+    determine_needs()
+    files = list(expand_files((args.files or []) + (args.input or []))) if args.files or args.input else []
+    if files and args.generate is not None:
+        logger.error("The FILE arguments cannot be combined with --generate.")
+        quit()
+    if {"filename", "file_count"} & clause_names and (args.whole or args.jobs or args.batch or args.concurrency):
+        logger.error("The `filename` and `file_count` variables are not available"
+                     " with --whole, --jobs, --batch or --concurrency.")
+        quit()
+
+    if not command["main"]:
+        # no main clause specified -> we may limit or turn off processing (and output)
+        # if the user needs the program to pipe out continuously, they might want to use `s` as the main clause
+        # running can be skipped or at least run partially to fill `lines`
+        args.run = 1 if need_lines or need_numbers or feed_numbers or feed_lines or "count" in clause_names else False
+
+    # empty variables available in the user scope
+    i = 0
+    S = set()
+    L = list()
+    D = dict()
+    C = Counter()
+    skip = None  # if user sets to False, the line will not be output
+
+    # prepare text processing (either fetch whole or line by line)
+    # Note: do not initialize the `text` to None. We want to be able to catch
+    # `<class 'NameError'> name 'text' is not defined` while not turning `--text` on
+    text: str
+    if args.generate is not None:
+        # `--generate=5` → 1,2,3,4,5
+        # `--generate=0` → 1 .. infinity
+        # `--generate=0 --overflow_safe` → 1 × infinity
+        # `--generate=1:1e9:10` → 1,11,21 .. 999999991
+        start, stop, step = args.generate
+        if stop is not None:  # finite
+            generated = islice(range(start, stop + (1 if step > 0 else -1), step), args.n)
+        else:  # infinite
+            generated = islice(repeat(start) if args.overflow_safe else count_from(start, step), args.n)
+        loop = ((x.encode(), x) for x in map(str, generated))  # lines for the other processing modes
+        logger.debug(f"Generating s = {start} " + ("× ∞" if stop is None and args.overflow_safe else
+                                                    f".. {'∞' if stop is None else stop}"
+                                                    + (f" by {step}" if step != 1 else "")))
+    elif args.whole:
+        # fetch whole text (a regular file is memory-mapped, not read)
+        try:
+            whole, start = read_whole_files(files) if files else read_whole(sys.stdin.buffer)
+        except KeyboardInterrupt:
+            logger.error("KeyboardInterrupt: Loading `text` interrupted.")
+            whole, start = b"", 0
+        end = len(whole)
+        while end > start and whole[end - 1] in b" \t\n\r\x0b\x0c":  # we strip the last newline
+            end -= 1
+        blocks = whole_blocks(whole, start, end)
+        loop = islice((split_records if need_r else split_blocks)(blocks), args.n)
+        if "text" in clause_names:
+            try:
+                text = str(memoryview(whole)[start:end], "utf-8")
+            except UnicodeError:
+                logger.warning("Cannot parse the text variable correctly")
+                text = str(memoryview(whole)[start:end], "utf-8", "replace")
+    else:
+        # load lines by blocks (while taking at most N lines)
+        blocks = read_files(files) if files else read_blocks(sys.stdin.buffer)
+        loop = islice((split_records if need_r else split_blocks)(blocks), args.n)
+
+    # collect the output into large writes, flush every line when on a terminal
+    # When generating, flush periodically. Ex: it took a lot of time before buffer flushed out when flushing
+    #   to another pz instance (and not to the console) in the command: `pz -g0 "s = randint(1,100); sleep(0.01)" | pz s
+    line_flush, size, interval, flush_idle = args.flush or flush_policy(
+        "line" if write_pipe.isatty() else "50ms" if args.generate is not None else "")
+    redirect_output(sys.stdout.buffer, sys.stderr.buffer, line_flush, size or BUFFER_SIZE, interval)
+    if meter:
+        meter.watch(sys.stdout.buffer)
+        if args.stderr:
+            meter.watch(sys.stderr.buffer)
+
+    # filled-in variables available in the user scope
+    b: bytes = None
+    s: str = None
+    n = None
+    r = None  # the record of the line, see `--split`, `--csv`, `--jsonl`
+    lines: list
+    numbers: list
+    count = 0  # itertools.count are imported as count_from ← more common to use this variable over the other
+    filename = None  # the FILE being processed (None for the STDIN)
+    file_count = 0  # the line number within the FILE
+
+    # internal processing variables
+    tried_to_correct_callable = False
+    write_line = collect_line if sorter or groups else learn_writer  # chosen by the type of the first output line
+    if stages:  # every clause outputs to the next one
+        for stage, following in zip(stages, stages[1:]):
+            stage.write = following.feed
+        if sorter or groups:
+            stages[-1].write = collect_line
+        stages[-1].skip_all, skip_all = skip_all, False
+        write_line = stages[0].feed
+    original_line: str = None
+
+    if args.batch and args.run is True:
+        try:
+            import numpy
+        except ImportError:
+            logger.error("The --batch flag needs NumPy: pip3 install numpy")
+            quit()
+        np = numpy
+    else:
+        args.batch = None
+
+    if args.jobs and args.run is True and not args.batch:
+        # fork the workers before the setup clause runs so that it is run once per worker
+        pool = start_pool()
+    else:
+        args.jobs = None
+
+    if args.concurrency and args.run is True and not args.batch and not args.jobs:
+        import asyncio
+        import inspect
+        from threading import Lock
+        running_loop, loop_lock = None, Lock()
+        if "get" in clause_names and globals().get("get") is getattr(sys.modules.get("requests"), "get", None):
+            get = pooled_get()  # imported ahead, see `determine_needs`
+    else:
+        args.concurrency = None
+
+    if (args.memo or args.memo_size or args.memo_file) and args.run is True:
+        if regular_command or args.jobs or args.batch or args.concurrency:
+            logger.error("The --memo flag cannot be combined with the regular expression flags,"
+                         " --jobs, --batch or --concurrency.")
+            quit()
+        names = code_names(compiled["main"][0])
+        shared = ({"i", "S", "L", "D", "C", "count", "lines", "numbers", "text", "filename", "file_count", *aggregators}
+                  & (names or set()))
+        if names is None or shared:
+            logger.error("The --memo flag cannot cache the clause that uses the shared state: "
+                         + (", ".join(sorted(shared)) if shared else "eval, exec, globals, vars or locals"))
+            quit()
+        # the results depend on the setup and on the flags that shape the variables of the line too
+        setup = (os.environ.get("PZ_SETUP", "") if args.insecure else "", args.setup or "")
+        flags = {name: getattr(args, name) for name in ("split", "csv", "jsonl", "n", "generate")
+                 if getattr(args, name) not in (None, False)}
+        memo = Memo(args.memo_size or 10000, args.memo_file, repr((command["main"], *setup, flags)))
+
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    # With `--jobs`, the main process runs the setup clause as well as every worker: the `--end` clause and the
+    # merging of the aggregators need its variables and its output is printed here once. Its side effects
+    # therefore happen NUM + 1 times (ex: a file opened for writing is truncated by each process).
+    run_setup()
+    # the setup might have changed an aggregator dynamically (ex: `--setup 'exec("P = 0")'`)
+    feed_numbers, feed_lines = fed_aggregators((), feed_numbers + feed_lines, globals())
+
+    # run processing
+    if meter:
+        meter.switch("clause")
+    if args.run:  # speed up when there is no main clause
+        if args.batch:
+            process_batches(loop)
+        elif args.jobs:
+            process_parallel(pool, loop)
+        elif args.concurrency:
+            process_concurrent(loop)
+        else:
+            pattern = regular_command and bulk_regex()
+            if args.generate is not None:
+                process(generated, True)
+            else:
+                process(process_regex(blocks, pattern) if pattern else loop)
+        if memo:
+            memo.close()
+        if stages:
+            stages[-1].hand_over()
+        if sorter or groups:
+            output_collected()
+    # run final script
+    if meter:
+        meter.switch("end")
+    if command["end"]:
+        if not args.whole and need_lines and "text" in clause_names:
+            # --text was off by default so we did not wait whole input to be piped in before processing.
+            # The variable `text` was not available before but there is no obstacle in letting it
+            # to be automatically available at the end – we have everything needed in the `lines` variable.
+            text = lines.text() if isinstance(lines, Lines) else "\n".join(lines)
+        as_lists(compiled["end"][0])
+
+        original_line = s = n = b = r = None
+        try:
+            while True:
+                with auto_import():
+                    execute("end")
+                    output(s, True)
+                    break
+        except BrokenPipeError:
+            logger.debug(f"BrokenPipeError: No output pipe in the --end clause '{command['end']}'")
+        except Exception as exc:
+            logger.warning(f'Exception: {type(exc)} {exc} in the --end clause')
+
+    # Gratuitous exit
+    # Ex: The middle command in `pz -g0 s | pz -E "sleep(1)" s | xargs echo` would often end up with
+    #   Exception ignored in: <_io.TextIOWrapper name='<stdout>' mode='w' encoding='utf-8'>
+    #   BrokenPipeError: [Errno 32] Broken pipe
+    # because `xargs` having received a SIGINT has already stopped.
+    # We prevent this situation by manually closing the STDOUT.
+    if args.stderr:
+        try:
+            sys.stderr.flush()
+        except BrokenPipeError:
+            pass
+    for pipe in (sys.stdout, sys.__stdout__):  # our buffer and the original stream
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+    if args.profile:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        print(f"Profile written, see: python3 -m pstats {args.profile}", file=sys.__stderr__)
+    if meter:
+        meter.report()
@@ -18,6 +18,7 @@ setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     scripts=['pz'],
+    py_modules=['pz_core'],  # the code, launched by the `pz` script
     classifiers=[
         'Programming Language :: Python :: 3',
         'Development Status :: 5 - Production/Stable',
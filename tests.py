@@ -1,10 +1,15 @@
+import json
 import logging
+import os
 import sys
 import unittest
+from importlib.util import find_spec
 from subprocess import Popen, PIPE, STDOUT, DEVNULL
-from time import time
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from time import time, sleep
 from types import GeneratorType
 from typing import Optional
+from unittest import skipUnless
 
 logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
 
@@ -181,6 +186,14 @@ class TestFlags(TestMaster):
                 setup="from datetime import timedelta",
                 expect="1230:00:05")
 
+        # imported ahead, the line is not reprocessed
+        self.go("i += 1; s = sleep(0) or i", "a\nb", setup="i = 0", expect=[1, 2])
+        self.go("D.get(s)", "a", verbosity=1, expect=["Changing the main clause to: s = D.get(s)"])  # no requests import
+        self.go("get(s)", "a", setup="get = str.upper", expect="A")
+        self.go("defaultdict(int)[s]", "a", expect="0")
+        self.go('eval("randint(1, 1)")', "a", verbosity=1,  # a dynamically built name is imported on the fly
+                expect=['Changing the main clause to: s = eval("randint(1, 1)")', 'Importing randint from random', 1])
+
         # when verbosity increased, we should get notified when an import happened
         self.go(r'Path("/")', previous_command="echo '123'", verbosity=0, expect='/')
         self.go(r'Path("/")', previous_command="echo '123'", verbosity=1,
@@ -288,6 +301,314 @@ class TestFlags(TestMaster):
             ("--stderr", b"", b"You have to specify either main COMMAND or --end COMMAND.\n")
         )]
 
+    def test_jobs(self):
+        """ Lines processed in worker processes are output in the input order, global variables get merged. """
+        numbers = range(1, 12_001)
+        stdin = "\n".join(str(x) for x in numbers).encode()
+        self.go("n*2", numbers, custom_cmd="-j3", expect=[x * 2 for x in numbers])
+        self.go("count", numbers, custom_cmd="-j3", expect=list(numbers))
+        self.check("-j3 -0 'C.update([n % 2])' --end C.most_common", ["1\t6000", "0\t6000"], None, stdin)
+        self.check("-j3 -0 'i = i + n' --end i", [sum(numbers)], None, stdin)
+        self.check("-j3 -0 s --end count", [len(numbers)], None, stdin)
+        self.check("-j2 s --stderr --end \"'end'\"", [1, 2], [1, 2, "end"], b"1\n2")
+        self.go("sha3_256(b).hexdigest()", "1", custom_cmd="-j2", setup="from hashlib import sha3_256",
+                expect="67b176705b46206614219f47a05aee7ae6a3edbe850bbbe214c536b989aea4d2")
+        # the setup clause runs in every worker, but its output is printed once
+        self.check("-j3 --setup 'print(\"header\"); x = 2' 'n * x'", ["header", 2, 4, 6], None, b"1\n2\n3")
+        with NamedTemporaryFile() as f:  # once per worker, and once in the main process (for the end clause)
+            self.check(f"-j2 --setup 'open(\"{f.name}\", \"a\").write(\"x\")' s", [1, 2], None, b"1\n2")
+            self.assertEqual(b"xxx", f.read())
+
+        unordered = Popen("./pz -j3 --unordered s", shell=True, stdout=PIPE, stdin=PIPE).communicate(stdin)[0]
+        self.assertListEqual(sorted(numbers), sorted(int(x) for x in unordered.split()))
+        for flag in ("--jobs=-1", "--batch=-1", "--concurrency=0"):
+            p = Popen(["./pz", "s", flag], stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE)
+            self.assertIn(f"invalid positive_int value: '{flag.split('=')[1]}'".encode(), p.communicate()[1])
+
+    def test_blocks(self):
+        """ Input is read and output is written by large blocks while the lines stay intact. """
+        long_line = "x" * 200_000  # spans over multiple blocks
+        self.go("len(s)", f"a\n{long_line}\nb", expect=[1, len(long_line), 1])
+        self.check("s", ["hello", long_line, "world"], None, f"hello  \r\n{long_line} \t\nworld\x0c".encode())
+        self.check("-n2 s", [1, 2], None, "\n".join(str(x) for x in range(100_000)).encode()[2:])
+        # the user clause printing to STDOUT keeps the order
+        self.go("print(count); s", "a\nb", expect=[1, "a", 2, "b"])
+        self.check("'s, b'", ["a\tb'a'", "\ufffd\tb'\\x80'", "c\tb'c'"], r"Cannot parse line correctly: b'\x80'",
+                   b"a\n\x80\nc")
+
+    @skipUnless(find_spec("numpy"), "NumPy not installed")
+    def test_batch(self):
+        """ The main clause is run once per chunk of lines, having NumPy arrays available. """
+        self.go("N.sum()", range(1, 11), custom_cmd="--batch=4", expect=[10.0, 26.0, 19.0])
+        self.go("N[N > 8]", range(1, 11), custom_cmd="--batch=4", expect=[9.0, 10.0])
+        self.go("S[0]", range(1, 11), custom_cmd="--batch=4", expect=[1, 5, 9])
+        self.go("N", "1\nhello\n2.5", custom_cmd="--batch=4", expect=[1.0, "nan", 2.5])
+        self.check("--batch 10 --split , 'COLS[0] * COLS[2]' --end count", [3.0, "nan", 42.0, 3],
+                   stdin=b"1,a,3\n4,b,x\n6,c,7")
+        self.check("--batch 2 'N.reshape(-1, 1) * [1, 2]'", ["1.0\t2.0", "2.0\t4.0", "3.0\t6.0"], stdin=b"1\n2\n3")
+        self.check("-g 100000 --batch 30000 -0 'i = i + N.sum()' --end i", [5000050000.0])
+
+    def test_concurrency(self):
+        """ Lines are processed at once in the threads, output in the input order unless --unordered. """
+        self.go("sleep(0.2 * (4 - n)) or s", "1\n2\n3", custom_cmd="--concurrency=3", expect=[1, 2, 3])
+        # the barrier lets the lines pass only when all three are in flight at once
+        self.go("(barrier.wait(10), s)[1]", "1\n2\n3", custom_cmd="--concurrency=3",
+                setup="from threading import Barrier; barrier = Barrier(3)", expect=[1, 2, 3])
+        self.check("--concurrency=3 --unordered 'sleep(0.2 * (4 - n)) or s'", [3, 2, 1], None, b"1\n2\n3")
+        self.go("asyncio.sleep(0.1, n * 2)", "1\n2", custom_cmd="--concurrency=2", expect=[2, 4])
+        self.go("S.add(s)", "1\n2\n2", custom_cmd="--concurrency=2", end="len(S)", expect=2)  # objects are shared
+        self.check("--concurrency=2 -0 'i = i + n' --end i", [0], None, b"1\n2")  # variables are local to the line
+        self.check("--concurrency=2 -F 'n > 1'", [2, 3], None, b"1\n2\n3")
+        # a callable is resolved with the line of its thread
+        self.check("--concurrency 2 sqrt", [2.0, 3.0, 4.0], "", b"4\n9\n16")
+        self.check("--concurrency 2 len", [3, 1], "", b"abc\nd")
+
+    @skipUnless(find_spec("requests"), "requests not installed")
+    def test_concurrency_get(self):
+        """ The auto-imported `get` keeps a connection per thread alive. """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from threading import Lock, Thread
+        connections = set()
+        in_flight = [0, 0]  # the requests being handled, the maximum of them
+        lock = Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive
+
+            def do_GET(self):
+                connections.add(self.client_address)
+                with lock:
+                    in_flight[0] += 1
+                    in_flight[1] = max(in_flight)
+                sleep(0.1)
+                with lock:
+                    in_flight[0] -= 1
+                body = self.path.encode()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            urls = [f"http://127.0.0.1:{server.server_port}/{x}" for x in range(20)]
+            self.go("get(s).text", urls, custom_cmd="--concurrency=4", expect=[f"/{x}" for x in range(20)])
+            self.assertGreater(in_flight[1], 1)  # the requests overlapped
+            self.assertLessEqual(in_flight[1], 4)
+            self.assertLessEqual(len(connections), 4)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_records(self):
+        """ The lines are parsed to the record `r`, a tuple is output in the same format. """
+        self.go("r[2]", CSV, custom_cmd="--split=|", expect=self.go(self.col2, CSV))
+        self.check("--split '|' 'r[::-1]'", ["c|b|a"], None, b"a|b|c")
+        self.check("--csv 'r[1]'", ["b1,b2,b3", 'y "q"'], None, b'"a","b1,b2,b3","c"\nx,"y ""q""",z')
+        self.check("--csv 'r[1], r[0]'", ['"b1,b2,b3",a'], None, b'"a","b1,b2,b3","c"')
+        self.check("--csv --split ';' 'r[2], r[0]'", ["c;a"], None, b"a;b;c")
+        self.check("--csv r", ["a", '"b""",c', "d"], None, b'"a\nb",c\nd')  # a quoted newline is not supported
+        self.check("--jsonl 'r[\"a\"]'", [1, 2], None, b'{"a": 1}\n{"a": 2, "b": [3]}')
+        self.check("--jsonl '{**r, \"c\": \"č\"}'", ['{"a": 1, "c": "č"}'], None, b'{"a": 1}')
+        self.check("--jsonl 'r'", ["1"], "Cannot parse the JSON line: 2, 3", b'1\n2, 3')
+        # a record does not span multiple lines
+        self.check("--jsonl 'r'", ["5"], "Cannot parse the JSON line: [1\nCannot parse the JSON line: 2]\n"
+                   "Cannot parse the JSON line: 3, 4", b'[1\n2]\n3, 4\n5')
+        self.check("--jsonl 'r'", ["5"], 'Cannot parse the JSON line: "a\nCannot parse the JSON line: ",1',
+                   b'"a\n",1\n5')
+        self.check("--jsonl 'r' --end count", [1, 2, 3, 3], None, b'1\n2\n3')
+        self.check("-j2 --csv 'r[1]'", ["b", "d"], None, b"a,b\nc,d")
+        self.check("--concurrency 2 --csv 'r[1]'", ["b", "d"], None, b"a,b\nc,d")
+
+    def test_files(self):
+        """ The FILE arguments are read one after another, decompressed, the glob patterns expanded. """
+        import bz2
+        import gzip
+        import lzma
+        with TemporaryDirectory() as tmp:
+            for name, compress in (("a.txt", bytes), ("b.gz", gzip.compress), ("c.bz2", bz2.compress),
+                                   ("d.xz", lzma.compress)):
+                with open(os.path.join(tmp, name), "wb") as f:
+                    f.write(compress(f"{name}:1\n{name}:2".encode()))  # no newline at the end
+            self.check(f"'f\"{{os.path.basename(filename)}} {{file_count}} {{count}} {{s}}\"' '{tmp}/*'",
+                       ["a.txt 1 1 a.txt:1", "a.txt 2 2 a.txt:2", "b.gz 1 3 b.gz:1", "b.gz 2 4 b.gz:2",
+                        "c.bz2 1 5 c.bz2:1", "c.bz2 2 6 c.bz2:2", "d.xz 1 7 d.xz:1", "d.xz 2 8 d.xz:2"])
+            self.check(f"'s + str(filename)' - {tmp}/b.gz -n 2", ["x-", f"b.gz:1{tmp}/b.gz"], None, b"x")
+            self.check(f"--end 'len(lines)' --input '{tmp}/[ab]*'", [4])
+            self.check(f"--whole --end 'text' --input {tmp}/a.txt --input {tmp}/d.xz",
+                       ["a.txt:1", "a.txt:2", "d.xz:1", "d.xz:2"])
+            self.check(f"s {tmp}/missing {tmp}/a.txt", ["a.txt:1", "a.txt:2"],
+                       f"Cannot read {tmp}/missing: [Errno 2] No such file or directory: '{tmp}/missing'")
+            self.check(f"-j2 filename {tmp}/a.txt", False, "The `filename` and `file_count` variables are not"
+                                                         " available with --whole, --jobs, --batch or --concurrency.")
+
+    def test_sort(self):
+        """ The lines are sorted at the end, spilled to the temporary files when over the memory limit. """
+        self.check("--sort", ["a", "a", "b", "c"], None, b"b\na\nc\na")
+        self.check("--sort=n", [2, 3, 10, "x"], None, b"3\n10\nx\n2")  # None key goes last
+        self.check("--sort=-n", [10, 3, 2], None, b"3\n10\n2")
+        self.check("'s.split()' --sort", ["a", "b", "c"], None, b"c a\nb")
+        # the keys of different types are ordered: the numbers, the strings, the tuples, the None last
+        self.check("--empty 'n if n else (s or None)' --sort --end '\"end\"'", [1, 2, "a", "b", "None", "end"],
+                   "", b"a\n2\n\n1\nb")
+        self.check("--sort='(n, s) if s == \"b\" else (n if n else s)' --mem-limit 1", ["1", "a", "c", "b"], "",
+                   b"c\nb\n1\na")
+        # a generated line is sorted as the text, the same as the read one
+        self.check("-g 12 --sort", sorted(str(x) for x in range(1, 13)), "")
+        self.check("-g 12 s --sort", sorted(str(x) for x in range(1, 13)), "")
+        lines = [f"{x * 7919 % 1000:03}" for x in range(3000)]
+        self.check("--sort --mem-limit 10K", sorted(lines), None, "\n".join(lines).encode())
+        self.check("'s[::-1]' --sort='int(s)' --mem-limit 10K", sorted((x[::-1] for x in lines), key=int), None,
+                   "\n".join(lines).encode())
+
+    def test_group_by(self):
+        """ The lines are grouped, the partial aggregates spilled when over the memory limit are merged. """
+        self.check("--group-by s", ["a\t3", "b\t2", "c\t1"], None, b"b\na\nc\na\nb\na")
+        self.check("--group-by s --sort=-s[1]", ["a\t3", "b\t2", "c\t1"], None, b"c\na\nb\na\nb\na")
+        self.check("--csv --group-by 'r[0]' --agg count --agg 'sum(int(r[1]))' --agg 'mean(int(r[1]))'"
+                   " --agg 'min(r[1])' --agg 'first(r[1])' --agg 'last(r[1])'",
+                   ["x,2,6,3.0,1,1,5", "y,1,2,2.0,2,2,2"], None, b"x,1\ny,2\nx,5")
+        self.check("-F 'n > 1' --group-by 'n % 2, n > 2'", ["0\tFalse\t1", "0\tTrue\t1", "1\tTrue\t1"], None,
+                   b"1\n2\n3\n4")
+        lines = [str(x % 500) for x in range(3000)]
+        self.check("--group-by n --agg count --agg 'first(count)' --mem-limit 10K",
+                   [f"{x}\t6\t{x + 1}" for x in range(500)], None, "\n".join(lines).encode())
+        self.check("--group-by s --agg 'median(n)'", False, "Cannot parse the --sort, --group-by or --agg expression:"
+                                                          " unknown aggregation 'median(n)'", b"1")
+        self.check("--agg count s", False, "The --agg flag needs --group-by.", b"1")
+
+    def test_chain(self):
+        """ The output values of a clause pass to the next one as objects, every clause counts its own lines. """
+        self.check("""'s.split(",")[1]' -c 'n+7'""", [12], None, b"hello,5")
+        self.check("sqrt -c round", [2, 3, 2], None, b"4\n9\n2.25")  # both callables resolved
+        self.check("-g 3 -c 'n * 2' -c '(s, type(n).__name__)'", ["2\tint", "4\tint", "6\tint"])
+        self.check("'(s, len(s))' -c 'r[1] * 10' -c 's + \"!\"'", ["10!", "20!"], None, b"a\nbb")
+        self.check("'s.split()' -c 'f\"{count}:{s}\"' --end count", ["1:a", "2:b", "3:c", 3], None, b"a b\nc")
+        self.check("'Path(s).suffix' -c '' --end 'Counter(lines).most_common'", [".txt\t2", ".mp4\t1"], None,
+                   b"a.txt\nb.mp4\nc.txt")
+        self.check("'n * 2' -c 'skip = n < 5' -c 'n + 1' -0 --end sum", [14], None, b"1\n2\n3\n4")
+        self.check("--search '(\\w)=(\\d)' -c 'int(r[1])' --sort=-s", [3, 2, 1], None, b"a=2\nb=3\nc=1")
+        self.check("-c '1 / n'", [1.0, 0.5], "Exception: <class 'ZeroDivisionError'> division by zero on line: 0",
+                   b"1\n0\n2")
+        self.check("b -c 'n + 1'", [2, 6], None, b"1\n5")  # the number of the bytes or another object
+        self.check("'Path(s)' -c 'n * 2'", [6], None, b"3")
+        self.check("-j2 s -c s", False, "The --chain flag cannot be combined with --jobs, --batch or --concurrency.",
+                   b"a")
+
+    def test_memo(self):
+        """ The clause runs once per distinct line, the results are kept across runs in the file. """
+        self.check("--memo 's.upper()' -v", ["A", "B", "A", "A"], "Changing the main clause to: s = s.upper()\n"
+                                                               "Memo: 2 hits, 2 misses", b"a\nb\na\na")
+        self.check("--memo-size 1 -F 'n > 2' -v", [5, 5, 5], "Changing the main clause to: skip = not n > 2\n"
+                                                       "Memo: 1 hits, 3 misses", b"5\n5\n1\n5")  # LRU of 1 line
+        # a cached line is passed to the STDOUT too
+        self.check("--memo --stderr 's.upper()'", ["a", "b", "a"], ["A", "B", "A"], b"a\nb\na")
+        self.check("'s + str(i)' --memo", False, "The --memo flag cannot cache the clause that uses the shared state: i",
+                   b"a")
+        self.check("'s + str(len(lines))' --memo", False,
+                   "The --memo flag cannot cache the clause that uses the shared state: lines", b"a")
+        self.check("'filename + s' --memo", False,
+                   "The --memo flag cannot cache the clause that uses the shared state: filename", b"a")
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "memo.sqlite")
+            self.check(f"'s * 2' --memo-file {path} -v", ["aa", "bb", "aa"], "Changing the main clause to: s = s * 2\n"
+                                                                            "Memo: 1 hits, 2 misses", b"a\nb\na")
+            self.check(f"'s * 2' --memo-file {path} -v", ["bb", "aa"], "Changing the main clause to: s = s * 2\n"
+                                                                     "Memo: 2 hits, 0 misses", b"b\na")
+            self.check(f"'s * 3' --memo-file {path} -v", ["aaa"], "Changing the main clause to: s = s * 3\n"
+                                                                "Memo: 0 hits, 1 misses", b"a")
+            # the setup and the flags shaping the line are a part of the key
+            self.check(f"-S 'x = 2' 's + str(x)' --memo-file {path}", ["a2"], "", b"a")
+            self.check(f"-S 'x = 3' 's + str(x)' --memo-file {path}", ["a3"], "", b"a")
+            self.check(f"--csv 'r[1]' --memo-file {path}", ["b;c"], "", b"a,b;c")
+            self.check(f"--csv --split ';' 'r[1]' --memo-file {path}", ["c"], "", b"a,b;c")
+
+    def test_flush(self):
+        """ The output is flushed when the input goes idle, not when the buffer gets full. """
+        for cmd in (["./pz", "s"], ["./pz", "s", "-"]):  # the STDIN given as the FILE argument streams too
+            p = Popen(cmd, stdin=PIPE, stdout=PIPE)
+            p.stdin.write(b"hello\n")
+            p.stdin.flush()
+            self.assertEqual(b"hello\n", p.stdout.readline())  # would block if the output waited for the buffer
+            p.stdin.close()
+            p.wait()
+            p.stdout.close()
+
+        self.check("--flush 50ms,1KiB 's * 2'", ["11", "22"], None, b"1\n2")
+        self.check("--flush never 's * 2'", ["11", "22"], None, b"1\n2")
+        p = Popen(["./pz", "s", "--flush", "5 lines"], stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE)
+        self.assertIn(b"invalid flush_policy value: '5 lines'", p.communicate()[1])
+
+    def test_stats(self):
+        """ The counters and the time breakdown are printed to the STDERR at the end. """
+        p = Popen(["./pz", "--stats", "--filter", "n % 2"], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = (x.decode().splitlines() for x in p.communicate(b"1\n2\n3\nx"))
+        self.assertEqual(["1", "3"], stdout)
+        self.assertIn("Exception", stderr[0])
+        self.assertIn("4 lines in", stderr[1])
+        self.assertIn("2 out, 1 skipped, 1 exceptions", stderr[1])
+        self.assertIn("numbers", stderr[3])
+        self.assertIn("clause", stderr[3])
+
+    def test_profile(self):
+        """ The processing is profiled into a pstats dump. """
+        from pstats import Stats
+        with NamedTemporaryFile() as f:
+            self.go("s.upper()", "a", custom_cmd=f"--profile={f.name}",
+                    expect=["A", f"Profile written, see: python3 -m pstats {f.name}"])
+            self.assertTrue(any(function == "process" for _, _, function in Stats(f.name).stats))
+
+    @skipUnless(hasattr(os, "fork"), "Unix only")
+    def test_serve(self):
+        """ The client hands the pipes, the arguments, the working directory and the environment over to the server.
+            Every request has a fresh namespace. Print the latency next to the direct `pz` call. """
+        with TemporaryDirectory() as tmp:
+            env = {**os.environ, "PZ_SERVER": os.path.join(tmp, "pz.sock"), "PZ": "./pz"}
+            server = Popen(["./pz", "--serve"], env=env, stderr=PIPE)
+            try:
+                while not os.path.exists(env["PZ_SERVER"]):
+                    sleep(0.01)
+
+                def client(*args, stdin=b"1\n2\n3", cwd=None, env_=None):
+                    p = Popen([sys.executable, "-S", os.path.abspath("extra/pz-client"), *args], env=env_ or env,
+                              cwd=cwd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+                    return (*(x.decode().splitlines() for x in p.communicate(stdin)), p.returncode)
+
+                self.assertEqual((["2", "4", "6"], [], 0), client("n * 2"))
+                self.assertEqual((["6"], [], 0), client("-0", "i = i + n", "--end", "i"))
+                self.assertEqual((["6"], [], 0), client("-0", "i = i + n", "--end", "i"))  # `i` starts from 0 again
+                self.assertEqual((["1", "2"], [], 0), client("-j2", "-n2", "s"))
+                stdout, stderr, status = client("--unknown-flag")
+                self.assertEqual(2, status)
+                self.assertIn("unrecognized arguments: --unknown-flag", stderr[-1])
+                self.assertEqual(([f"{tmp}\tvalue"], [], 0), client("-1", "os.getcwd(), os.environ['PZ_TEST']", cwd=tmp,
+                                                                  env_={**env, "PZ_TEST": "value"}))
+                # no server listening, the client launches `pz` itself
+                self.assertEqual((["2"], [], 0), client("-1", "n * 2", env_={**env, "PZ_SERVER": tmp + "/none"}))
+
+                def latency(cmd, runs=20):
+                    start = time()
+                    for _ in range(runs):
+                        Popen(cmd, env=env, stdin=DEVNULL, stdout=DEVNULL).communicate()
+                    return (time() - start) / runs * 1000
+                served = latency([sys.executable, "-S", "extra/pz-client", "s"])
+                direct = latency([sys.executable, "-S", "./pz", "s"])
+                print(f"\nLatency: `pz s` {direct:.0f} ms, served {served:.0f} ms", file=sys.stderr)
+            finally:
+                server.send_signal(2)  # SIGINT
+                server.communicate()
+            self.assertFalse(os.path.exists(env["PZ_SERVER"]))
+
+            # a path that is not a socket of the user is not replaced
+            open(env["PZ_SERVER"], "w").close()
+            _, stderr = Popen(["./pz", "--serve"], env=env, stderr=PIPE).communicate()
+            self.assertIn(b"exists and is not a socket of yours", stderr)
+            self.assertTrue(os.path.exists(env["PZ_SERVER"]))
+
 
 class TestVariables(TestMaster):
 
@@ -303,6 +624,19 @@ class TestVariables(TestMaster):
         self.go(r"len(text)", LOREM, expect=[forgotten_text] + [exc_text + v for v in LOREM.splitlines()])
         self.go(r"len(text)", LOREM, expect=[], quiet=True)
 
+    def test_text_from_file(self):
+        """ The whole regular file is memory-mapped, lines are split as in the pipe. """
+        with NamedTemporaryFile("wb") as f:
+            f.write("a \r\nžluť\r\rc\n\n  \n".encode())
+            f.flush()
+            for cmd in (f"./pz -w 's, len(text)' < {f.name}", f"cat {f.name} | ./pz -w 's, len(text)'"):
+                self.assertEqual(b"a\t11\n\xc5\xbelu\xc5\xa5\t11\n\t11\nc\t11\n",
+                                 Popen(cmd, shell=True, stdout=PIPE).communicate()[0])
+            self.assertEqual(b"a\n", Popen(f"./pz -w1 s < {f.name}", shell=True, stdout=PIPE).communicate()[0])
+            # the input is not read from the beginning of the file
+            self.assertEqual("žluť\nc\n".encode(), Popen(f"(read x; ./pz -w s) < {f.name}", shell=True,
+                                                         stdout=PIPE).communicate()[0])
+
     def test_skip(self):
         """ Variable can be skipped """
         self.go("skip = s in c; c.add(s);", "1\n2\n2\n3", setup="c=set();", expect=["1", "2", "3"])
@@ -327,6 +661,74 @@ class TestVariables(TestMaster):
         self.go("n+5", "1", expect=6)
         self.go("s+5", "1", expect=[], quiet=True)
 
+    def test_demand_driven(self):
+        """ Only the variables the clauses refer to are computed. """
+        main = 'getattr(sys.modules["__main__"], "n")'
+        self.go(main, "5", empty=True, expect="None")
+        self.go(f"n and {main}", "5", expect=5)
+
+        populated = 'hasattr(sys.modules["__main__"], "lines")'
+        self.go(populated, "5", expect="False", empty=True)
+        self.go("s", "5", end=populated, expect=[5, "False"], empty=True)
+        self.go("s", "5", end=f"{populated} and len(lines)", expect=[5, 1])
+        self.go("s", "5", end=f"{populated} and len(text)", expect=[5, 1])
+        self.go("", "5\n6", end="sum", expect=11)  # callable might be given `numbers`
+
+    def test_lines_and_numbers(self):
+        """ `lines` and `numbers` are lists, stored compactly while only the end clause refers to them. """
+        self.go("", "1\n2.5\nhey\n3", end="numbers", expect=[1, 2.5, 3])
+        self.go("", "1\n2.5\nhey\n3", end="sum(numbers)", expect=6.5)
+        self.go("", f"1\n{2 ** 70}", end="numbers", expect=[1, 2 ** 70])
+        self.go("", "a\nžluť\nb", end="lines", expect=["a", "žluť", "b"])
+        self.go("", "a\nžluť\nb", end="lines[::-1]", expect=["b", "žluť", "a"])
+        self.go("", "a\nžluť\nb", end="lines[-2]", expect="žluť")
+        self.go("", "b\na\nb", end="lines.sort(); s = lines + ['c']", expect=["a", "b", "b", "c"])
+        self.go("", "b\na\nb", end="' - '.join", expect="b - a - b")
+        self.go("", "a\nb", end="text", expect=["a", "b"])  # `lines` stay compact for the `text` only
+        self.go("", "a\nb", end="len(text), len(lines)", expect="3\t2")
+
+        # the clauses get real lists
+        self.check("--setup 'import json' --end 'json.dumps(lines), json.dumps(numbers)'", '["1", "2"]\t[1, 2]',
+                   stdin=b"1\n2")
+        self.go("", "a\nb", end="lines * 2", expect=["a", "b", "a", "b"])
+        self.go("", "a\nb", end="['x'] + lines", expect=["x", "a", "b"])
+        self.go("", "a\nb", end="s = lines.copy()", expect=["a", "b"])
+        self.go("", "a\nb", end="isinstance(lines, list), isinstance(numbers, list)", expect="True\tTrue")
+        self.go("", "a\nb", end="lines.append(5); s = lines", expect=["a", "b", 5])
+        self.go("", "1\n2\n3", end="numbers.reverse(); numbers.remove(2); s = numbers.pop(), numbers",
+                expect="1\t[3]")
+        self.check("'lines.append(s * 2) if n == 2 else None' --end lines", ["1", "2", "1", "2", "22"], stdin=b"1\n2")
+        # a line containing a newline stays a single line
+        self.check("'\"x\\ny\" if s == \"a\" else s' -c s --end 'len(lines), lines[0]'",
+                   ["x", "y", "b", "2\tx", "y"], stdin=b"a\nb")
+        # mutating a long list is not quadratic
+        self.check("--end 'lines.reverse(); [lines.pop() for _ in range(len(lines))]; s = len(lines)'", "0",
+                   stdin=b"\n".join(b"%d" % i for i in range(300000)))
+
+    def test_aggregators(self):
+        """ Streaming aggregators are fed with every number or line when referenced. """
+        self.go("", "1\n2\n3\nhey\n4", end="R", expect=["count\t4", "sum\t10", "mean\t2.5",
+                                                          "stdev\t1.2909944487358056", "min\t1", "max\t4"])
+        self.go("", "1\n2\n3\n4\n5", end="P.quantile", expect=3)
+        self.go("", "a\nb\na\nc\na\nb", end="K.most_common(2)", expect=["a\t3", "b\t2"])
+        self.go("", "a\nb\na\nc\na\nb", end="H", expect=3)
+        # a name the user assigns to is not fed
+        self.check("-S 'P = 0' -0 'P = P + n' --end P", "6", "", b"1\n2\n3")
+        self.check("-0 'H = n' --end H", "3", "", b"1\n2\n3")
+        self.check("""-S 'exec("K = 0")' --end K""", "0", "", b"1\n2\n3")
+        # the classes are available on their own (the README example)
+        self.check("'q.add(int(s.split()[1]))' -S 'q = Stats()' -0 --end 'q.mean'", "2.0", "", b"a 1\nb 2\nc 3")
+        self.go("", "1\n2\n3\n4\n5", end="Quantiles(numbers).quantile()", expect=3)
+
+        numbers = range(1, 100_001)
+        stdin = "\n".join(str(x) for x in numbers).encode()
+        self.check("--overflow-safe --end 'R.mean'", [50000.5], None, stdin)
+        self.check("-j3 -0 s --end 'R.sum, R.max'", [f"{sum(numbers)}\t100000"], None, stdin)
+        for cmd in ("--overflow-safe --end 'P.quantile(0.99), H'", "-j3 -0 s --end 'P.quantile(0.99), H'"):
+            quantile, distinct = Popen(f"./pz {cmd}", shell=True, stdout=PIPE, stdin=PIPE).communicate(stdin)[0].split()
+            self.assertAlmostEqual(99_000, int(quantile), delta=1000)
+            self.assertAlmostEqual(100_000, int(distinct), delta=2000)
+
     def test_set(self):
         self.go("S.add(s)", "2\n1\n2\n3\n1", end="sorted(S)", expect=["1", "2", "3"])
 
@@ -357,8 +759,17 @@ class TestVariables(TestMaster):
                                                                      ("-g0 s --overflow-safe", [1, 1, 1, 1, 1]),
                                                                      ("-g10", [1, 2, 3, 4, 5]),
                                                                      ("-g -1", [1]),
-                                                                     ("-g -n2", [1, 2])
+                                                                     ("-g -n2", [1, 2]),
+                                                                     ("-g 1:1e2:25", [1, 26, 51, 76]),
+                                                                     ("-g 10:1:-4 's + \"!\"'", ["10!", "6!", "2!"]),
+                                                                     ("-g 5: -n3 'n * 2'", [10, 12, 14]),
+                                                                     ("-g 0::-1", [0, -1, -2, -3, -4]),
+                                                                     ("-g 1::3 --overflow-safe", [1, 1, 1, 1, 1]),
+                                                                     ("-g2 'b + b\"!\"'", ["1!", "2!"]),
+                                                                     ("-g2 -F 'n > 1'", [2]),
                                                                      )]
+        p = Popen(["./pz", "-g", "1:5:0"], stdout=PIPE, stderr=PIPE)  # zero step
+        self.assertIn(b"invalid generate_range value: '1:5:0'", p.communicate()[1])
 
     def test_bytes(self):
         stdin, stdout = b'hello\n\x80invalid\nworld', ["hello", "€invalid", "world"]
@@ -466,6 +877,14 @@ class TestReturnValues(TestMaster):
         self.go("", num, end="len", expect=["4"])
         self.go("", "1\n", end="len", expect=["1"])
 
+    def test_callable_not_bare(self):
+        """ A clause that is not a bare callable is not rewritten, a callable is resolved for that line only. """
+        self.go("str if n == 1 else s", "1\n2\n3", expect=["2", "3"])
+        self.go('(lambda: "x") if n == 1 else s', "1\n2\n3", expect=["x", "2", "3"])
+        self.go('D.get(s, lambda: "default")', "1\n2\n3", setup='D = {"2": "two"}',
+                expect=["default", "two", "default"])
+        self.go("sqrt if n == 4 else s", "1\n4\n9", expect=["1", "2.0", "9"])
+
     def test_callable_with_no_output(self):
         """ When treating callable, we have to be able to put the line as its parameter.
             However, we have to distinguish the cases when there is an output (should be displayed)
@@ -526,6 +945,39 @@ class TestReturnValues(TestMaster):
         # using groups
         self.go(r"[ae](.)", "hello world\nanother words", sub=r"\1-", expect=["hl-lo world", "n-othr- words"])
 
+    def test_regex_blocks(self):
+        """ The regular expression flags scan whole blocks as bytes, the output must stay the same as line by line. """
+        text = "see http://a.cz and https://b.cz  \nnothing\nhttp://c.cz"
+        self.go(r"https?://\S+", text, custom_cmd="--findall", expect=["http://a.cz", "https://b.cz", "http://c.cz"])
+        self.go(r"https?://\S+", text, custom_cmd="--search", expect=["http://a.cz", "http://c.cz"])
+        self.go(r"https?://\S+", text, custom_cmd="--findall", text=True,
+                expect=["http://a.cz", "https://b.cz", "http://c.cz"])
+        self.go(r"(x)?(https?)", text, custom_cmd="--findall", expect=["\thttp", "\thttps", "\thttp"])
+        self.go(r"(x)?(https?)", text, custom_cmd="--search", expect=["None\thttp", "None\thttp"])
+        self.go(r"(x)?", "a\nb", custom_cmd="--search", expect=["None", "None"])
+        self.go(r"\w+$", "ab cd\nef", custom_cmd="--search", expect=["cd", "ef"])
+        self.go(r"\w+", "ab cd\nef", sub="-", expect=["- -", "-"])
+
+        # a match spanning over the newline, a non-ASCII line and `\x1c` (str `\s` matches it) fall back to line by line
+        self.go(r"\s+", "a \nb", sub="_", expect=["a", "b"])
+        self.go(r"\w+", "ab\nřeš", custom_cmd="--findall", expect=["ab", "řeš"])
+        self.go(r"\S+", "a\x1cb", custom_cmd="--findall", expect=["a", "b"])
+        # `\B` or a pattern matching empty would find the positions between the lines, processed line by line
+        self.go(r"\B", "a\n\n\tb", sub="-", expect=["a", "-\tb"])
+        self.go(r"x*", "a\n\n\tb", sub="-", expect=["-a-", "-", "-\t-b-"])
+
+    def test_writer(self):
+        """ The writer specialized by the type of the first line falls back to the generic output for another type. """
+        self.go("s if n % 2 else (n, 'x')", range(1, 5), expect=["1", "2\tx", "3", "4\tx"])
+        self.go("None if n == 1 else [s, s] if n == 2 else s", range(1, 4), expect=["2", "2", "3"])
+        self.go("None if n == 1 else s", range(1, 3), empty=True, expect=["None", "2"])
+        self.go("n if n > 1 else b", range(3), expect=["0", "1", "2"])
+        self.go("'' if n == 1 else s", range(3), expect=["0", "2"])
+        self.go(r"search(r'(\d)(x)?|y', s)", "1\ny\n2x", expect=["1\tNone", "None\tNone", "2\tx"])
+        self.go(r"search(r'\d*', s)", "1\ny\n2x", expect=["1", "2"])
+        self.go("s.upper", "a\nb", verbosity=2,
+                expect=["Changing the main clause to: s = s.upper", "Changing the main clause to: s = s.upper()", "A", "B"])
+
     def test_output_tuples_in_list(self):
         """ If we encounter a list of tuples, we properly joins tuples on independents lines. """
         # The bad thing would be to print out this (see the parenthesis)
@@ -561,5 +1013,77 @@ else:
 ''', piped_text="1\n2\n3", expect=["smaller", "smaller", "bigger"])
 
 
+class TestPerformance(TestMaster):
+    def test_compiled_clause(self):
+        """ The clause is compiled once instead of handing its source to `exec` on every line.
+            Print the lines-per-second figure of both approaches and of the whole `pz` run. """
+        lines = [str(x) for x in range(100_000)]
+        source = "s = s.upper()"
+
+        def measure(run):
+            start = time()
+            for s in lines:
+                run({"s": s})
+            return len(lines) / (time() - start)
+
+        code = compile(source.partition("=")[2].strip(), "<string>", "eval")
+        before = measure(lambda scope: exec(source, scope))
+        after = measure(lambda scope: eval(code, scope))
+
+        start = time()
+        self.assertEqual(len(lines), len(self.go("s.upper()", lines)))
+        total = len(lines) / (time() - start)
+
+        print(f"\nClause throughput: {before:,.0f} lines/s (exec source) → {after:,.0f} lines/s (compiled),"
+              f" pz: {total:,.0f} lines/s", file=sys.stderr)
+        self.assertGreater(after, before * 2)
+
+    def test_startup(self):
+        """ The common `pz COMMAND` invocation neither imports the argparse nor the logging and the launcher
+            does not compile the code, it comes from the cached bytecode of the `pz_core` module.
+            Print the import time and the wall time of `echo x | pz s` next to the bare interpreter start. """
+        from importlib.util import cache_from_source
+        from py_compile import compile as compile_module
+        compile_module("pz_core.py", doraise=True)  # as the installation does, no matter `PYTHONDONTWRITEBYTECODE`
+        stderr = Popen([sys.executable, "-v", "./pz", "s"], stdin=PIPE, stdout=PIPE, stderr=PIPE) \
+            .communicate(b"x")[1].decode()
+        self.assertIn(f"code object from {os.path.abspath(cache_from_source('pz_core.py'))!r}", stderr)
+
+        stderr = Popen([sys.executable, "-X", "importtime", "./pz", "s"], stdin=PIPE, stdout=PIPE, stderr=PIPE) \
+            .communicate(b"x")[1].decode()
+        imports = {line.split("|")[2].strip(): int(line.split("|")[1]) for line in stderr.splitlines()
+                   if line.startswith("import time:") and not line.split("|")[2].startswith("  ")
+                   and "cumulative" not in line}
+        self.assertNotIn("argparse", imports)
+        self.assertNotIn("logging", imports)
+
+        def wall_time(cmd, runs=20):
+            times = []
+            for _ in range(runs):
+                start = time()
+                Popen(cmd, shell=True, stdout=DEVNULL).communicate()
+                times.append(time() - start)
+            return sorted(times)[runs // 2] * 1000
+
+        python, pz, flags = (wall_time(f"echo x | {sys.executable} {cmd}") for cmd in ("-c pass", "./pz s", "./pz -1 s"))
+        print(f"\nStartup: python {python:.0f} ms, `pz s` {pz:.0f} ms, `pz -1 s` (argparse) {flags:.0f} ms,"
+              f" imports besides the site {(sum(imports.values()) - imports.get('site', 0)) / 1000:.0f} ms",
+              file=sys.stderr)
+
+    def test_benchmarks(self):
+        """ The benchmark suite stores the results that the next run compares to. """
+        with NamedTemporaryFile(suffix=".json") as f:
+            cmd = [sys.executable, "benchmarks/run.py", "--lines", "1000", "--repeat", "1", "--only", "plain|findall"]
+            Popen([*cmd, "--output", f.name], stdout=DEVNULL).communicate()
+            results = json.load(f)["results"]
+            self.assertEqual(["findall", "plain"], sorted(results))
+            self.assertGreater(results["plain"]["lines_per_second"], 0)
+            self.assertGreater(results["plain"]["max_rss_kib"], 0)
+
+            p = Popen([*cmd, "--compare", f.name, "--threshold", "100"], stdout=PIPE)
+            self.assertIn(b"No regression", p.communicate()[0])
+            self.assertEqual(0, p.returncode)
+
+
 if __name__ == '__main__':
     unittest.main()